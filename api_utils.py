@@ -1,38 +1,187 @@
+import io
+import threading
+import time
+from urllib.parse import quote
+
 import requests
-from config import CENTRAL_NODE_ADDRESS, NODE_NAME, NODE_ADDRESS
+from utils import fan_out, encode_cursor, msgpack, pack, unpack, MSGPACK_MIMETYPE
+from snapshot import read_chunks
+from metrics import observe
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (CENTRAL_NODE_ADDRESS, NODE_NAME, NODE_ADDRESS, RPC_TIMEOUT, RPC_CONNECT_TIMEOUT,
+                    PROPOSAL_TIMEOUT, SYNC_TIMEOUT, SYNC_PAGE_SIZE, RPC_RETRIES, RPC_RETRY_BACKOFF,
+                    RPC_POOL_CONNECTIONS, RPC_POOL_MAXSIZE, MEMBERSHIP_CACHE_TTL, PING_TIMEOUT,
+                    HEALTH_CHECK_TIMEOUT, SNAPSHOT_READ_BUFFER, RPC_WIRE_FORMAT, MEMBERSHIP_WATCH_TIMEOUT,
+                    LEADER_LEASE_ENABLED, SHARD_ID)
+
+
+def _make_session(retries=RPC_RETRIES) -> requests.Session:
+    """
+    Make a session shared by all rpc, it keeps a pool of keep-alive connections per peer.
+    Connect errors are retried for every method since request is not sent yet,
+        other errors are only retried for GET which is idempotent.
+    :param retries: max retries of a request, 0 to fail at first error
+    """
+    retry = Retry(total=retries, backoff_factor=RPC_RETRY_BACKOFF, allowed_methods=frozenset(["GET"]),
+                  status_forcelist=(502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=RPC_POOL_CONNECTIONS, pool_maxsize=RPC_POOL_MAXSIZE, max_retries=retry)
+    s = requests.Session()
+    s.mount("http://", adapter)
+    return s
+
+
+session = _make_session()
+# health checks and leader discovery are never retried, a dead peer fails them within their deadline
+probe_session = _make_session(0)
+
+# rpc bodies are encoded in msgpack if it's configured and installed, or json
+_use_msgpack = RPC_WIRE_FORMAT == "msgpack" and msgpack is not None
+if RPC_WIRE_FORMAT == "msgpack" and msgpack is None:
+    print("msgpack is not installed, rpc falls back to json")
+_headers = {"Accept": "{}, application/json;q=0.9".format(MSGPACK_MIMETYPE)} if _use_msgpack else {}
+
+_node_cache = {"nodes": {}, "etag": None, "version": None, "expire": 0}
+_node_cache_lock = threading.Lock()
+# leader of other shards, e.g. {1: {"address": "2.2.2.2:5000", "expire": 0}}
+_shard_leader_cache = {}
+# registry of central node is asked for shard of this node
+_shard_params = {"shard": SHARD_ID}
+
+
+def _get(address, path, timeout=RPC_TIMEOUT, headers=None, **kwargs) -> requests.Response:
+    return session.get('http://{}{}'.format(address, path), timeout=(RPC_CONNECT_TIMEOUT, timeout),
+                       headers=dict(_headers, **(headers or {})), **kwargs)
+
+
+def _probe(address, path, timeout) -> requests.Response:
+    """
+    GET without retry, both connect and read are bounded by timeout.
+    """
+    return probe_session.get('http://{}{}'.format(address, path), timeout=(timeout, timeout), headers=_headers)
+
+
+def _put(address, path, timeout=RPC_TIMEOUT, json=None, **kwargs) -> requests.Response:
+    if _use_msgpack:
+        kwargs["data"] = pack(json)
+        kwargs["headers"] = dict(_headers, **{"Content-Type": MSGPACK_MIMETYPE})
+    else:
+        kwargs["json"] = json
+    return session.put('http://{}{}'.format(address, path), timeout=(RPC_CONNECT_TIMEOUT, timeout), **kwargs)
+
+
+def _decode(resp: requests.Response):
+    """
+    Decode body of a response, in msgpack or json according to its Content-Type.
+    """
+    if resp.headers.get("Content-Type", "").startswith(MSGPACK_MIMETYPE):
+        return unpack(resp.content)
+    return resp.json()
 
 
-def get_all_data(address) -> [dict]:
+def iter_data_since(address, seq, page_size=SYNC_PAGE_SIZE, path='/data/since/'):
     """
-    Get all data from a node.
+    Walk data of a node committed after given seq page by page, ordered by seq.
     :param address: address of node
-    :return: data, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
+    :param seq: only data with greater seq are returned
+    :param page_size: count of data in a page, node may return less if it's above DATA_PAGE_MAX_LIMIT of node
+    :param path: endpoint to read, '/data/since/' reads db and '/log/since/' reads replication log
+    :return: generator of page, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 2}],
+        raise if any page failed.
     """
-    try:
-        r = requests.get('http://{}/data/'.format(address)).json()
-        if r.get("result", "") == "ok":
-            return r.get("data", [])
-    except Exception as e:
-        print(e)
-        return []
+    while True:
+        r = _decode(_get(address, path, timeout=SYNC_TIMEOUT, params={"seq": seq, "limit": page_size}))
+        if r.get("result", "") != "ok":
+            raise Exception("get data from {} failed: {}".format(address, r.get("msg", "")))
+        page = r.get("data", [])
+        # a short page doesn't mean the end, page size may be clamped by node
+        if not page:
+            return
+        yield page
+        seq = page[-1]["seq"]
+
+
+def iter_snapshot_chunks(address, seq=None, cursor=None):
+    """
+    Stream a snapshot of a node chunk by chunk, only one chunk is in memory at a time.
+    :param address: address of node
+    :param seq: seq of snapshot to resume, None to start a new snapshot at node's high-water mark
+    :param cursor: data_id of last data already received, None to start from first chunk
+    :return: generator of header and data of chunk, see snapshot.read_chunks.
+        raise LookupError if node refused to serve the snapshot, or other exception if transfer failed.
+    """
+    params = {}
+    if seq is not None:
+        params["seq"] = seq
+    if cursor is not None:
+        params["cursor"] = encode_cursor(cursor)
+    with _get(address, '/snapshot/', timeout=SYNC_TIMEOUT, params=params, stream=True) as r:
+        # a refusal is an error response in json or msgpack, a snapshot is streamed in octet-stream
+        if r.headers.get("Content-Type", "").startswith(("application/json", MSGPACK_MIMETYPE)):
+            raise LookupError("get snapshot from {} failed: {}".format(address, _decode(r).get("msg", "")))
+        yield from read_chunks(io.BufferedReader(r.raw, SNAPSHOT_READ_BUFFER))
+
+
+def get_merkle(address, level=None, indexes=()) -> dict:
+    """
+    Get merkle tree of a node, its root or children of given nodes of tree.
+    :param address: address of node
+    :param level: level of given nodes, None to get root
+    :param indexes: index of nodes in their level
+    :return: e.g. {"root": "ab12...", "buckets": 4096, "fanout": 16},
+        or children of each node if level is given, e.g. {"children": {"0": ["ab12...", ...]}}, raise if failed.
+    """
+    params = {} if level is None else {"level": level, "index": list(indexes)}
+    r = _decode(_get(address, '/merkle/', timeout=SYNC_TIMEOUT, params=params))
+    if r.get("result", "") != "ok":
+        raise Exception("get merkle tree from {} failed: {}".format(address, r.get("msg", "")))
+    return r.get("data", {})
+
+
+def get_buckets(address, buckets) -> dict:
+    """
+    Get all data in given buckets of merkle tree of a node.
+    :param address: address of node
+    :param buckets: buckets, e.g. [0, 1]
+    :return: data and high-water mark of node read before them,
+        e.g. {"applied_seq": 1, "data": [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]}, raise if failed.
+    """
+    r = _decode(_get(address, '/merkle/bucket/', timeout=SYNC_TIMEOUT, params={"bucket": list(buckets)}))
+    if r.get("result", "") != "ok":
+        raise Exception("get buckets from {} failed: {}".format(address, r.get("msg", "")))
+    return r.get("data", {})
 
 
-def ping(address) -> bool:
+def ping(address, timeout=PING_TIMEOUT) -> bool:
     """
     Check a node if is alive.
     :param address: address of node
+    :param timeout: deadline of this request in seconds
     :return: result of check, bool
     """
     ret = False
     try:
-        r = requests.get('http://{}/ping/'.format(address)).json()
+        r = _decode(_probe(address, '/ping/', timeout))
         if r.get("result", "") == "ok":
             ret = True
     except Exception as e:
         print(e)
+        invalidate_node_cache()
     return ret
 
 
+def timed_ping(address, timeout=PING_TIMEOUT) -> (bool, float):
+    """
+    Check a node if is alive and measure its latency.
+    :param address: address of node
+    :param timeout: deadline of this request in seconds
+    :return: result of check, bool and latency in seconds
+    """
+    start = time.time()
+    ret = ping(address, timeout)
+    return ret, time.time() - start
+
+
 def register() -> bool:
     """
     Register to central node.
@@ -40,11 +189,30 @@ def register() -> bool:
     """
     ret = False
     try:
-        r = requests.put('http://{}/register/'.format(CENTRAL_NODE_ADDRESS),
-                         json={'name': NODE_NAME, "address": NODE_ADDRESS}).json()
+        r = _decode(_put(CENTRAL_NODE_ADDRESS, '/register/', json={'name': NODE_NAME, "address": NODE_ADDRESS},
+                             params=_shard_params))
         print("Register result: {}".format(r))
         if r.get("result", "") == "ok":
             ret = True
+            invalidate_node_cache()
+    except Exception as e:
+        print(e)
+    return ret
+
+
+def send_heartbeat() -> bool:
+    """
+    Send heartbeat to central node, to keep this node registered.
+    :return: result of heartbeat, bool
+    """
+    ret = False
+    try:
+        r = _decode(_put(CENTRAL_NODE_ADDRESS, '/heartbeat/', json={'name': NODE_NAME, "address": NODE_ADDRESS},
+                             params=_shard_params))
+        if r.get("result", "") == "ok":
+            ret = True
+        else:
+            print("Heartbeat result: {}".format(r))
     except Exception as e:
         print(e)
     return ret
@@ -60,108 +228,334 @@ def send_proposal(address, data) -> (bool, str):
     ret = False
     msg = None
     try:
-        r = requests.put('http://{}/proposal/'.format(address),
-                         json=data).json()
-        print("proposal result: {}".format(r))
+        r = _decode(_put(address, '/proposal/', json=data, timeout=PROPOSAL_TIMEOUT))
         if r.get("result", "") == "ok":
             ret = True
         else:
             msg = r.get("msg", "")
+            print("proposal failed: {}".format(msg))
     except Exception as e:
         print(e)
+        invalidate_node_cache()
     return ret, msg
 
 
-def send_prepare(address, data) -> (bool, str):
+def get_data_item(address, data_id) -> (bool, dict):
     """
-    Send prepare to a node.
+    Get a data by its data_id from a node.
+    :param address: address of node
+    :param data_id: id of data
+    :return: result, bool or None if node is unreachable, and data, e.g. {"data_id": "1", "raw": "a",
+        "signature": "aaa", "seq": 1}, or msg if failed.
+    """
+    try:
+        r = _decode(_get(address, '/data/{}'.format(quote(str(data_id), safe=''))))
+        if r.get("result", "") == "ok":
+            return True, r.get("data")
+        return False, r.get("msg", "")
+    except Exception as e:
+        print(e)
+        return None, "Node {} unreachable.".format(address)
+
+
+def send_batch_proposal(address, data) -> (bool, list):
+    """
+    Send a batch of data as proposal to a node.
     :param address: address of node
     :param data: data, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
+    :return: result, bool and result of each data, e.g. [{"data_id": "1", "result": "ok"}], or msg if failed.
+    """
+    ret = False
+    msg = None
+    try:
+        r = _decode(_put(address, '/proposal/', json=data, timeout=PROPOSAL_TIMEOUT))
+        if r.get("result", "") == "ok":
+            ret = True
+            msg = r.get("data", [])
+        else:
+            msg = r.get("msg", "")
+            print("batch proposal failed: {}".format(msg))
+    except Exception as e:
+        print(e)
+        invalidate_node_cache()
+    return ret, msg
+
+
+def send_prepare(address, data, timeout=RPC_TIMEOUT) -> (bool, str):
+    """
+    Send prepare to a node.
+    :param address: address of node
+    :param data: transaction and its data,
+        e.g. {"txn_id": "ab12", "data": [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]}
+    :param timeout: deadline of this request in seconds
     :return: result, bool and msg if failed.
     """
     ret = False
     msg = None
     try:
-        r = requests.put('http://{}/prepare/'.format(address),
-                         json=data).json()
-        print("prepare result: {}".format(r))
+        r = _decode(_put(address, '/prepare/', json=data, timeout=timeout))
         if r.get("result", "") == "ok":
             ret = True
         else:
             msg = r.get("msg", "")
+            print("prepare failed: {}".format(msg))
     except Exception as e:
         print(e)
+        invalidate_node_cache()
     return ret, msg
 
 
-def send_submit(address) -> (bool, str):
+def send_submit(address, data, timeout=RPC_TIMEOUT) -> (bool, str):
     """
     Send submit to a node.
     :param address: address of node
+    :param data: transaction to submit and seq of its data, e.g. {"txn_id": "ab12", "first_seq": 1, "last_seq": 10}
+    :param timeout: deadline of this request in seconds
     :return: result, bool and msg if failed.
     """
     ret = False
     msg = None
     try:
-        r = requests.put('http://{}/submit/'.format(address)).json()
-        print("submit result: {}".format(r))
+        r = _decode(_put(address, '/submit/', json=data, timeout=timeout))
         if r.get("result", "") == "ok":
             ret = True
         else:
             msg = r.get("msg", "")
+            print("submit failed: {}".format(msg))
     except Exception as e:
         print(e)
+        invalidate_node_cache()
     return ret, msg
 
 
-def send_rollback(address, data) -> (bool, str):
+def send_rollback(address, data, timeout=RPC_TIMEOUT) -> (bool, str):
     """
     Send rollback to a node.
     :param address: address of node
-    :param data: data, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
+    :param data: transaction to roll back, e.g. {"txn_id": "ab12"}
+    :param timeout: deadline of this request in seconds
     :return: result, bool and msg if failed.
     """
     ret = False
     msg = None
     try:
-        r = requests.put('http://{}/rollback/'.format(address),
-                         json=data).json()
-        print("rollback result: {}".format(r))
+        r = _decode(_put(address, '/rollback/', json=data, timeout=timeout))
         if r.get("result", "") == "ok":
             ret = True
         else:
             msg = r.get("msg", "")
+            print("rollback failed: {}".format(msg))
     except Exception as e:
         print(e)
+        invalidate_node_cache()
     return ret, msg
 
 
-def get_all_node() -> dict:
+def send_log_append(address, data, timeout=RPC_TIMEOUT) -> (bool, str):
     """
-    Get all node from central node.
-    :return: list of nodes, e.g. [{"name":"aaa", "address":"1.1.1.1"}]
+    Send entries to append to replication log of a node.
+    :param address: address of node
+    :param data: entries and if wait for them durable,
+        e.g. {"entries": [{"type": "prepare", "txn_id": "ab12", "data": [...]}], "sync": True}
+    :param timeout: deadline of this request in seconds
+    :return: result, bool and msg if failed.
     """
+    ret = False
+    msg = None
     try:
-        r = requests.get('http://{}/register/'.format(CENTRAL_NODE_ADDRESS)).json()
-        return r.get("data", [])
+        r = _decode(_put(address, '/log/append/', json=data, timeout=timeout))
+        if r.get("result", "") == "ok":
+            ret = True
+        else:
+            msg = r.get("msg", "")
+            print("log append result: {}".format(r))
     except Exception as e:
         print(e)
-        return []
+        invalidate_node_cache()
+    return ret, msg
 
 
-def get_all_node_leader() -> dict:
+def get_all_node() -> dict:
     """
-    Get leader of all node.
-    :return: dict of node's leader, e.g. {"aaa": "bbb"}
+    Get all node, from local cache if it's fresh, or revalidate it with central node by a conditional request.
+    If central node is unreachable, the stale cache is returned.
+    :return: dict of nodes, e.g. {"aaa": "1.1.1.1"}
     """
-    ret = {}
-    for name, address in get_all_node().items():
+    if time.time() < _node_cache["expire"]:
+        return dict(_node_cache["nodes"])
+    with _node_cache_lock:
+        # another thread may have refreshed it while we are waiting for lock
+        if time.time() < _node_cache["expire"]:
+            return dict(_node_cache["nodes"])
+        start = time.perf_counter()
+        status = "error"
         try:
-            r = requests.get('http://{}/leader/'.format(address)).json()
-            ret[name] = r.get("data", {}).get("leader", "")
+            headers = {"If-None-Match": _node_cache["etag"]} if _node_cache["etag"] else {}
+            resp = _get(CENTRAL_NODE_ADDRESS, '/register/', headers=headers, params=_shard_params)
+            if resp.status_code != 304:
+                _node_cache["nodes"] = _decode(resp).get("data", {})
+                _node_cache["etag"] = resp.headers.get("ETag")
+                _node_cache["version"] = int(_node_cache["etag"].strip('"')) if _node_cache["etag"] else None
+            _node_cache["expire"] = time.time() + MEMBERSHIP_CACHE_TTL
+            status = str(resp.status_code)
         except Exception as e:
             print(e)
-    return ret
+        observe("dbs_membership_fetch_seconds", time.perf_counter() - start, status=status)
+        return dict(_node_cache["nodes"])
+
+
+def watch_node_cache(timeout=MEMBERSHIP_WATCH_TIMEOUT) -> bool:
+    """
+    Wait for changes of node list from central node by a long poll, and apply them to cached node list.
+    Cached node list is trusted until the next long poll should have returned, so it's not revalidated in between.
+    If central node holds too many watches, it answers right away and cached node list is trusted for
+        MEMBERSHIP_CACHE_TTL seconds only, as if node list is polled.
+    :param timeout: seconds central node waits for a change
+    :return: if central node held the watch, caller should wait a while before next watch if not
+    """
+    start = time.perf_counter()
+    try:
+        params = dict(_shard_params, timeout=timeout, version=_node_cache["version"])
+        r = _decode(_get(CENTRAL_NODE_ADDRESS, '/register/watch/', timeout=timeout + RPC_TIMEOUT, params=params))
+        if r.get("result", "") != "ok":
+            raise Exception("watch node list failed: {}".format(r.get("msg", "")))
+    except Exception as e:
+        print(e)
+        invalidate_node_cache()
+        return False
+    data = r["data"]
+    with _node_cache_lock:
+        # node list may be refreshed by get_all_node to a newer version meanwhile, changes apply to it as well
+        if _node_cache["version"] is None or data["version"] >= _node_cache["version"]:
+            nodes = data["nodes"] if "nodes" in data else dict(_node_cache["nodes"])
+            for change in data.get("changes", []):
+                if change["op"] == "add":
+                    nodes[change["name"]] = change["address"]
+                else:
+                    nodes.pop(change["name"], None)
+            _node_cache["nodes"] = nodes
+            _node_cache["version"] = data["version"]
+            _node_cache["etag"] = '"{}"'.format(data["version"])
+        _node_cache["expire"] = time.time() + (MEMBERSHIP_CACHE_TTL if data.get("poll") else timeout + RPC_TIMEOUT)
+    result = "poll" if data.get("poll") else "nodes" if "nodes" in data else "changes"
+    observe("dbs_membership_watch_seconds", time.perf_counter() - start, result=result)
+    return not data.get("poll")
+
+
+def invalidate_node_cache():
+    """
+    Mark cached node list as expired, next get_all_node will revalidate it with central node.
+    Should be called when a peer is unreachable since node list may be changed.
+    """
+    _node_cache["expire"] = 0
+
+
+def get_lease(timeout=PING_TIMEOUT, shard=SHARD_ID) -> dict:
+    """
+    Get holder of leader lease of a shard from central node.
+    :param timeout: deadline of this request in seconds
+    :param shard: shard of leader, this node's by default
+    :return: lease, e.g. {"leader": "aaa", "address": "1.1.1.1:5000", "ttl": 0.8, "epoch": 3},
+        "leader" is "" if no one holds it, None if failed.
+    """
+    try:
+        r = _decode(_get(CENTRAL_NODE_ADDRESS, '/lease/', timeout=timeout, params={"shard": shard}))
+        if r.get("result", "") == "ok":
+            return r.get("data")
+        print("get lease result: {}".format(r))
+    except Exception as e:
+        print(e)
+
+
+def acquire_lease(ttl, timeout=PING_TIMEOUT) -> dict:
+    """
+    Acquire leader lease for this node from central node if no one holds it, or renew it if this node holds it.
+    :param ttl: seconds that lease is held without another renewal
+    :param timeout: deadline of this request in seconds
+    :return: lease after acquired, see get_lease, None if failed.
+    """
+    try:
+        r = _decode(_put(CENTRAL_NODE_ADDRESS, '/lease/', json={"name": NODE_NAME, "ttl": ttl}, timeout=timeout,
+                         params=_shard_params))
+        if r.get("result", "") == "ok":
+            return r.get("data")
+        print("acquire lease result: {}".format(r))
+    except Exception as e:
+        print(e)
+
+
+def release_lease(timeout=PING_TIMEOUT) -> bool:
+    """
+    Release leader lease of this node, so another node takes over without waiting it expire.
+    :param timeout: deadline of this request in seconds
+    :return: result of release, bool
+    """
+    try:
+        r = _decode(_put(CENTRAL_NODE_ADDRESS, '/lease/', json={"name": NODE_NAME, "release": True},
+                         timeout=timeout, params=_shard_params))
+        return r.get("result", "") == "ok"
+    except Exception as e:
+        print(e)
+        return False
+
+
+def get_leader(address, timeout=PING_TIMEOUT) -> str:
+    """
+    Get leader of a node.
+    :param address: address of node
+    :param timeout: deadline of this request in seconds
+    :return: name of leader, "" if node has no leader, None if failed.
+    """
+    try:
+        r = _decode(_probe(address, '/leader/', timeout))
+        return r.get("data", {}).get("leader", "")
+    except Exception as e:
+        print(e)
+        invalidate_node_cache()
+
+
+def get_shard_leader(shard) -> str:
+    """
+    Get address of leader of another shard, from local cache if it's fresh.
+    Leader is read from leader lease of the shard, or asked from a registered node of the shard if lease is disabled.
+    :param shard: shard of leader
+    :return: address of leader, None if the shard has no leader or it's unknown.
+    """
+    cached = _shard_leader_cache.get(shard)
+    if cached and time.time() < cached["expire"]:
+        return cached["address"]
+    address = None
+    try:
+        if LEADER_LEASE_ENABLED:
+            address = (get_lease(shard=shard) or {}).get("address")
+        else:
+            nodes = _decode(_get(CENTRAL_NODE_ADDRESS, '/register/', params={"shard": shard})).get("data", {})
+            for node_address in nodes.values():
+                leader = get_leader(node_address)
+                if leader is not None:
+                    address = nodes.get(leader)
+                    break
+    except Exception as e:
+        print(e)
+    if address:
+        _shard_leader_cache[shard] = {"address": address, "expire": time.time() + MEMBERSHIP_CACHE_TTL}
+    return address
+
+
+def invalidate_shard_leader(shard):
+    """
+    Forget cached leader of a shard, should be called when it's unreachable or no longer leader.
+    """
+    _shard_leader_cache.pop(shard, None)
+
+
+def get_all_node_leader() -> dict:
+    """
+    Get leader of all node concurrently, node not answered in time is skipped.
+    :return: dict of node's leader, e.g. {"aaa": "bbb"}
+    """
+    results, pending = fan_out(get_leader, get_all_node(), timeout=HEALTH_CHECK_TIMEOUT)
+    return {name: leader for name, leader in results.items() if leader is not None}
 
 
 def kill_node(address):
@@ -169,6 +563,6 @@ def kill_node(address):
     Kill a node!!
     """
     try:
-        requests.get('http://{}/kill/'.format(address)).json()
+        _decode(_get(address, '/kill/'))
     except:
         ...
@@ -1,89 +1,443 @@
+import json
 import os
 import signal
 import threading
 import time
-
-from flask import Flask, request
-from db import (check_data_id_dup, get_all_data_from_db, insert_data_to_prepare,
-                submit_prepare, del_prepare, insert_data)
+import uuid
+
+from flask import Flask, Response, request
+from db import (init_db, get_existing_data_ids, get_all_data_from_db, get_data_page, get_data_since,
+                iter_all_data_from_db, insert_data_to_prepare, submit_prepare, del_prepare, insert_data,
+                get_max_seq, get_applied_seq, set_applied_seq, apply_data, get_log_applied_index,
+                set_log_applied_index, get_dup_index_stats, get_snapshot_page, get_snapshot_progress,
+                apply_snapshot_chunk, finish_snapshot, clear_snapshot_progress, get_data_by_ids,
+                get_data_cache_stats, merkle_tree, get_data_in_buckets, repair_buckets, connection_context,
+                close_connection, get_db_pool_stats, del_settled_prepare)
+from group_commit import GroupCommitter
+from sequencer import Sequencer
+from metrics import inc, observe, timer, gauge, render
+from replication_log import ReplicationLog
+from snapshot import encode_chunk, encode_end
+from sharding import HashRing
 from collections import OrderedDict, defaultdict
-
-from utils import make_ok_response, make_json_response, make_error_response, validate_data
-from api_utils import (ping, register, get_all_node, get_all_node_leader,
-                       send_proposal, kill_node, send_prepare, send_submit, send_rollback, get_all_data)
-from redis_utils import add_node, del_node, get_all_nodes_from_redis
-from config import IS_CENTRAL_NODE, NODE_PORT, NODE_NAME, NODE_ADDRESS, NODE_CHECK_INTERVAL
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import (make_ok_response, make_json_response, make_error_response, make_not_modified_response,
+                   validate_data, fan_out, encode_cursor, decode_cursor, get_request_data, wants_msgpack,
+                   parse_limit)
+from api_utils import (timed_ping, register, send_heartbeat, get_all_node, get_all_node_leader, send_proposal,
+                       send_batch_proposal, kill_node, send_prepare, send_submit, send_rollback, send_log_append,
+                       iter_data_since, iter_snapshot_chunks, get_lease, acquire_lease, release_lease,
+                       invalidate_node_cache, get_merkle, get_buckets, watch_node_cache, get_shard_leader,
+                       invalidate_shard_leader, get_data_item)
+from redis_utils import (add_node, del_node, get_registered_nodes, expire_nodes, get_node_version, get_node_address,
+                         hold_lease, drop_lease, get_lease_from_redis, wait_node_changes)
+from config import (IS_CENTRAL_NODE, NODE_PORT, NODE_NAME, NODE_ADDRESS, NODE_CHECK_INTERVAL,
+                    HEARTBEAT_ENABLED, HEARTBEAT_INTERVAL, SERVER_MODE, SERVER_THREADS, SERVER_CONNECTION_LIMIT,
+                    SERVER_BACKLOG, SERVER_CHANNEL_TIMEOUT,
+                    PREPARE_TIMEOUT, SUBMIT_TIMEOUT, ROLLBACK_TIMEOUT, SEQUENCER_TURN_TIMEOUT, HEALTH_CHECK_TIMEOUT,
+                    GROUP_COMMIT_MAX_SIZE, GROUP_COMMIT_LINGER, GROUP_COMMIT_WORKERS, DATA_PAGE_MAX_LIMIT, DATA_STREAM_CHUNK_SIZE,
+                    REPLICATION_LOG_ENABLED, REPLICATION_LOG_PATH, REPLICATION_LOG_SEGMENT_BYTES,
+                    REPLICATION_LOG_RETAIN_SEGMENTS, REPLICATION_LOG_PREPARE_EXPIRE, SNAPSHOT_CHUNK_SIZE,
+                    SNAPSHOT_COMPRESS_LEVEL, LEADER_LEASE_ENABLED, LEADER_LEASE_TTL, LEADER_LEASE_RENEW_INTERVAL,
+                    LEADER_LEASE_CHECK_INTERVAL, LEADER_LEASE_BACKOFF, ANTI_ENTROPY_ENABLED, ANTI_ENTROPY_INTERVAL,
+                    ANTI_ENTROPY_BATCH, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_WATCH_ENABLED, MEMBERSHIP_WATCH_MAX,
+                    MEMBERSHIP_WATCH_TIMEOUT, COMMIT_POLICY, CATCH_UP_INTERVAL, QUORUM_MAX_INFLIGHT, PROPOSAL_TIMEOUT,
+                    SHARD_ID, SHARD_IDS, SHARD_VNODES, SHARD_FORWARD_WORKERS)
 
 app = Flask(__name__)
 
 LEADER = None
 STOP = False
+# latency of last ping to each node, in seconds
+NODE_LATENCY = {}
+# replication log of this node if it's enabled
+LOG = None
+# data_ids of transactions prepared in replication log, and data_ids committed in log but not applied to db yet,
+#   leader checks both for dup id since db lags behind log.
+LOG_TXNS = {}
+UNAPPLIED_IDS = set()
+# seq assigned by this node as leader, last seq is loaded from db when this node becomes leader
+sequencer = Sequencer()
+# data_ids of commit rounds in flight on this node as leader
+INFLIGHT_IDS = set()
+INFLIGHT_LOCK = threading.Lock()
+# monotonic time until which leader lease of this node is surely held, if this node is leader
+LEASE_EXPIRE = 0
+# in majority policy, if this node as leader has pulled data committed by quorums it missed, see catch_up_as_leader
+CAUGHT_UP = False
+CATCH_UP_LOCK = threading.Lock()
+# shard owns each data_id, the same on all nodes
+ring = HashRing(SHARD_IDS, SHARD_VNODES)
+# forwarded proposals wait for whole commit rounds of other leaders, they don't take threads 2PC fans out on
+shard_executor = ThreadPoolExecutor(max_workers=SHARD_FORWARD_WORKERS, thread_name_prefix="shard-forward")
+# membership watches held by this node as central node, each one takes a handler thread until it's answered
+watch_slots = threading.BoundedSemaphore(MEMBERSHIP_WATCH_MAX)
+
+
+def holds_lease() -> bool:
+    """
+    :return: if this node can act as leader, always True if leader lease is disabled
+    """
+    return not LEADER_LEASE_ENABLED or (LEADER == NODE_NAME and time.monotonic() < LEASE_EXPIRE)
 
 
-def prepare(data) -> (bool, list):
+def quorum(nodes) -> (callable, callable):
     """
-    send prepare request to all node, will interrupt and return immediately when any node prepare failed.
-    :return: result of prepare, False if anyone is False, and list of node who prepare success.
+    Majority of nodes including this node, a phase succeeds once it succeeded in quorum in majority policy.
+    :param nodes: nodes of the phase, e.g. {"aaa": "1.1.1.1:5000"}
+    :return: check on results if quorum succeeded, and if it's decided, that's succeeded or can't succeed any more
     """
-    success = []
-    for name, address in get_all_node().items():
-        ret, msg = send_prepare(address, data)
-        if not ret:
-            return False, success
-        else:
-            success.append(name)
+    need = len(nodes) // 2 + 1
+
+    def reached(results):
+        success = [name for name, (ret, msg) in results.items() if ret]
+        return NODE_NAME in success and len(success) >= need
+
+    def decided(results):
+        failed = [name for name, (ret, msg) in results.items() if not ret]
+        return reached(results) or NODE_NAME in failed or len(failed) > len(nodes) - need
+
+    return reached, decided
+
+
+def prepare(txn_id, data) -> (bool, list):
+    """
+    send prepare request to all node concurrently, will stop waiting and return as soon as any node prepare failed.
+    In majority policy, return as soon as quorum prepared or failed, other nodes are left behind, see quorum.
+    If replication log is enabled, prepare is a durable append of data to log of node.
+    :return: result of prepare, False if anyone (quorum in majority policy) is False or not finished in time,
+        and list of node who prepare success or still in flight, these need to be rolled back if failed.
+    """
+    if REPLICATION_LOG_ENABLED:
+        func, data = send_log_append, {"entries": [{"type": "prepare", "txn_id": txn_id, "data": data}], "sync": True}
+    else:
+        func, data = send_prepare, {"txn_id": txn_id, "data": data}
+    nodes = get_all_node()
+    if COMMIT_POLICY == "majority":
+        reached, decided = quorum(nodes)
+        with timer("dbs_phase_seconds", phase="prepare"):
+            results, pending = fan_out(func, nodes, data, timeout=PREPARE_TIMEOUT, until=decided,
+                                       max_inflight=QUORUM_MAX_INFLIGHT, phase="prepare")
+        success = [name for name, (ret, msg) in results.items() if ret]
+        if not reached(results):
+            return False, success + pending
+        inc("dbs_quorum_left_behind_total", len(nodes) - len(success), phase="prepare")
+        return True, success + pending
+    with timer("dbs_phase_seconds", phase="prepare"):
+        results, pending = fan_out(func, nodes, data, timeout=PREPARE_TIMEOUT, abort=lambda res: not res[0],
+                                   phase="prepare")
+    success = [name for name, (ret, msg) in results.items() if ret]
+    if pending or len(success) != len(results):
+        return False, success + pending
     return True, success
 
 
-def submit() -> list:
+def submit(txn_id, first_seq, last_seq) -> list:
     """
-    send submit request to all node.
-    :return: result of prepare, False if anyone is False, and list of node who prepare success.
+    send submit request to all node concurrently.
+    In majority policy, return as soon as quorum submitted or failed, other nodes are left behind, see quorum.
+    If replication log is enabled, submit is an append of commit to log of node, no need to wait it durable
+        since a node lost it will catch up from leader.
+    :return: list of node who submit failed or not finished in time, empty if quorum submitted in majority policy.
     """
-    failed = []
-    for name, address in get_all_node().items():
-        ret, msg = send_submit(address)
-        if not ret:
-            failed.append(name)
+    data = {"txn_id": txn_id, "first_seq": first_seq, "last_seq": last_seq}
+    func = send_submit
+    if REPLICATION_LOG_ENABLED:
+        func, data = send_log_append, {"entries": [dict(data, type="commit")], "sync": False}
+    nodes = get_all_node()
+    if COMMIT_POLICY == "majority":
+        reached, decided = quorum(nodes)
+        with timer("dbs_phase_seconds", phase="submit"):
+            results, pending = fan_out(func, nodes, data, timeout=SUBMIT_TIMEOUT, until=decided,
+                                       max_inflight=QUORUM_MAX_INFLIGHT, phase="submit")
+    else:
+        reached = None
+        with timer("dbs_phase_seconds", phase="submit"):
+            results, pending = fan_out(func, nodes, data, timeout=SUBMIT_TIMEOUT, phase="submit")
+    failed = [name for name, (ret, msg) in results.items() if not ret] + pending
+    if reached and reached(results):
+        inc("dbs_quorum_left_behind_total", len(failed), phase="submit")
+        return []
+    return failed
+
+
+def rollback(nodes, txn_id, first_seq=None, last_seq=None) -> list:
+    """
+    send rollback request to given nodes concurrently.
+    If seq of the transaction is given, nodes skip it, it must be sent in order of seq as submit.
+    In majority policy, rollback of all nodes returns as soon as quorum rolled back or failed, see quorum.
+    :param nodes: name of nodes to roll back, None for all nodes
+    :return: result of rollback, list of node who is rollback failed or not finished in time,
+        empty if quorum rolled back all nodes in majority policy.
+    """
+    reached = None
+    if nodes is None and COMMIT_POLICY == "majority":
+        reached, decided = quorum(get_all_node())
+    nodes = {name: address for name, address in get_all_node().items() if nodes is None or name in nodes}
+    func, data = send_rollback, {"txn_id": txn_id}
+    if first_seq is not None:
+        data.update(first_seq=first_seq, last_seq=last_seq)
+    if REPLICATION_LOG_ENABLED:
+        func, data = send_log_append, {"entries": [dict(data, type="abort")], "sync": False}
+    with timer("dbs_phase_seconds", phase="rollback"):
+        if reached:
+            results, pending = fan_out(func, nodes, data, timeout=ROLLBACK_TIMEOUT, until=decided,
+                                       max_inflight=QUORUM_MAX_INFLIGHT, phase="rollback")
+        else:
+            results, pending = fan_out(func, nodes, data, timeout=ROLLBACK_TIMEOUT, phase="rollback")
+    failed = [name for name, (ret, msg) in results.items() if not ret] + pending
+    if reached and reached(results):
+        inc("dbs_quorum_left_behind_total", len(failed), phase="rollback")
+        return []
     return failed
 
 
-def rollback(nodes, data) -> list:
+def last_used_seq() -> int:
     """
+    Last seq used by a committed or aborted round, loaded by a new leader.
+    Seq committed in replication log may not be applied to db yet, so both are read.
+    """
+    return max(get_max_seq(), LOG.last_seq if LOG is not None else 0)
+
 
-    :return: result of rollback, list of node who is rollback failed
+def commit_batch(records) -> [(bool, str)]:
     """
-    failed = []
-    for name, address in get_all_node().items():
-        if name not in nodes:
-            continue
-        ret, msg = send_rollback(address, data)
+    commit a batch of records in one prepare/submit round, records with duplicated data_id are rejected alone.
+    Rounds run concurrently, data_ids of a round are reserved until it's finished, so they're rejected by others.
+    Each round gets its range of seq before prepare, and submits or rolls back after rounds before it, see Sequencer.
+    :return: result of each record, bool and msg if failed.
+    """
+    inc("dbs_commit_rounds_total")
+    inc("dbs_commit_round_records_total", len(records))
+    results = [None] * len(records)
+    data_ids = [record.get("data_id", "") for record in records]
+    reserved = []
+    with INFLIGHT_LOCK:
+        for i, data_id in enumerate(data_ids):
+            if data_id in INFLIGHT_IDS:
+                results[i] = (False, "dup id!")
+            else:
+                INFLIGHT_IDS.add(data_id)
+                reserved.append(i)
+    try:
+        with connection_context():
+            return _commit_reserved(records, reserved, results)
+    finally:
+        with INFLIGHT_LOCK:
+            INFLIGHT_IDS.difference_update(data_ids[i] for i in reserved)
+
+
+def _commit_reserved(records, reserved, results) -> [(bool, str)]:
+    if COMMIT_POLICY == "majority" and not catch_up_as_leader():
+        for i in reserved:
+            results[i] = (False, "Leader is catching up.")
+        return results
+
+    data_ids = [records[i].get("data_id", "") for i in reserved]
+    with timer("dbs_dup_check_seconds"):
+        existed = get_existing_data_ids(data_ids) | UNAPPLIED_IDS.intersection(data_ids)
+    accepted = []
+    for i in reserved:
+        if records[i].get("data_id", "") in existed:
+            results[i] = (False, "dup id!")
+        else:
+            accepted.append(i)
+
+    if not accepted:
+        return results
+
+    def finish(ret, msg):
+        for i in accepted:
+            results[i] = (ret, msg)
+        return results
+
+    if not holds_lease():
+        return finish(False, "Not leader.")
+
+    txn_id = uuid.uuid4().hex
+    data = [records[i] for i in accepted]
+    term, first_seq, last_seq = sequencer.allocate(len(data), last_used_seq)
+    in_turn = False
+    try:
+        for seq, record in enumerate(data, first_seq):
+            record["seq"] = seq
+        ret, success = prepare(txn_id, data)
+        in_turn = sequencer.wait_turn(term, first_seq, SEQUENCER_TURN_TIMEOUT)
+
+        if not in_turn or not holds_lease():
+            # leadership changed or a round before is stuck while preparing, the same seq may be assigned again
+            rollback(success, txn_id)
+            return finish(False, "Not leader." if not holds_lease() else "Wait turn timeout.")
+
         if not ret:
-            failed.append(name)
-    return failed
+            # all nodes skip seq of this round, nodes failed to prepare too
+            ret = [name for name in rollback(None, txn_id, first_seq, last_seq) if name in success]
+
+            if not ret:
+                return finish(False, "prepare failed, rollback success!")
+            else:
+                nodes = get_all_node()
+                for name in ret:
+                    kill_node(nodes[name])
+                return finish(False, "prepare failed, rollback failed!")
+
+        # seq of this round are used once any node may submit them, failed node will catch up by sync
+        failed = submit(txn_id, first_seq, last_seq)
+        if failed:
+            return finish(False, "submit failed, failed list: {}".format(failed))
+
+        return finish(True, None)
+    except Exception:
+        if not in_turn and sequencer.wait_turn(term, first_seq, SEQUENCER_TURN_TIMEOUT):
+            # round failed before its turn, all nodes skip its seq so rounds after it are submitted in order
+            rollback(None, txn_id, first_seq, last_seq)
+        raise
+    finally:
+        sequencer.done(term, last_seq)
+
+
+committer = GroupCommitter(commit_batch, GROUP_COMMIT_MAX_SIZE, GROUP_COMMIT_LINGER, GROUP_COMMIT_WORKERS)
+
+gauge("dbs_node_latency_seconds", lambda: {(("node", name),): latency for name, latency in NODE_LATENCY.items()})
+gauge("dbs_is_leader", lambda: int(LEADER is not None and LEADER == NODE_NAME))
+gauge("dbs_last_seq", lambda: sequencer.last_seq)
+gauge("dbs_inflight_records", lambda: len(INFLIGHT_IDS))
+gauge("dbs_dup_index", lambda: {(("stat", k),): v for k, v in get_dup_index_stats().items()})
+gauge("dbs_data_cache", lambda: {(("stat", k),): v for k, v in get_data_cache_stats().items()})
+gauge("dbs_db_pool_connections", lambda: {(("state", k),): v for k, v in get_db_pool_stats().items()})
+
+
+@app.teardown_request
+def teardown_request(exc):
+    """
+    Close connection opened by a handler to db, or return it to pool, connection is opened by first query of handler.
+    """
+    if not IS_CENTRAL_NODE:
+        close_connection()
 
 
 @app.route('/register/', methods=['GET', 'PUT'])
 def register_handler():
     """
-    register handler, action determine by http method
-    If http method is "GET", will return all registered node.
+    register handler, action determine by http method, nodes are of "shard" in query string, 0 by default
+    If http method is "GET", will return all registered node, or 304 if client's If-None-Match is still fresh.
     If http method is "PUT", will register a node.
     :return: Flask response
     """
     if not IS_CENTRAL_NODE:
         return make_error_response("This is a common node, not provide Registry service.")
+    shard = request.args.get("shard", 0, type=int)
+    if shard not in SHARD_IDS:
+        return make_error_response("Unknown shard {}.".format(shard))
     if request.method == 'GET':
-        return make_json_response(get_all_nodes_from_redis())
+        # read version before nodes, so a client never caches new nodes under an old version
+        version = str(get_node_version(shard))
+        if request.if_none_match.contains(version):
+            return make_not_modified_response(version)
+        return make_json_response(get_registered_nodes(shard), etag=version)
     if request.method == 'PUT':
-        req = request.json
-        res = add_node(req.get("name"), req.get("address"))
+        req = get_request_data()
+        res = add_node(req.get("name"), req.get("address"), shard=shard)
         if res:
             return make_ok_response()
         else:
             return make_error_response("Insert failed.")
 
 
+@app.route('/register/watch/', methods=['GET'])
+def register_watch_handler():
+    """
+    register watch handler, wait until registered nodes of "shard" are changed after "version" of query string,
+        or MEMBERSHIP_WATCH_TIMEOUT seconds ("timeout" of query string if it's shorter).
+    Return changes after the version, e.g. {"version": 3, "changes": [{"version": 3, "op": "add", "name": "aaa",
+        "address": "1.1.1.1:5000"}]}, or all nodes if no version is given or changes are not kept any more,
+        e.g. {"version": 3, "nodes": {"aaa": "1.1.1.1:5000"}}.
+    If MEMBERSHIP_WATCH_MAX watches are held already, answer right away with "poll": true, the node polls instead.
+    :return: Flask response
+    """
+    if not IS_CENTRAL_NODE:
+        return make_error_response("This is a common node, not provide Registry service.")
+    shard = request.args.get("shard", 0, type=int)
+    if shard not in SHARD_IDS:
+        return make_error_response("Unknown shard {}.".format(shard))
+    if request.method == 'GET':
+        try:
+            version = request.args.get("version", type=int)
+            timeout = min(float(request.args.get("timeout", MEMBERSHIP_WATCH_TIMEOUT)), MEMBERSHIP_WATCH_TIMEOUT)
+        except ValueError as e:
+            return make_error_response("Invalid watch: {}".format(e))
+        held = watch_slots.acquire(blocking=False)
+        if not held:
+            timeout = 0
+            inc("dbs_membership_watch_refused_total")
+        try:
+            changes = None
+            if version is not None:
+                current, changes = wait_node_changes(version, timeout, shard)
+        finally:
+            if held:
+                watch_slots.release()
+        if changes is None:
+            # read version before nodes, so a client never takes new nodes for an old version
+            current = get_node_version(shard)
+            data = {"version": current, "nodes": get_registered_nodes(shard)}
+        else:
+            data = {"version": current, "changes": changes}
+        if not held:
+            data["poll"] = True
+        return make_json_response(data)
+
+
+@app.route('/heartbeat/', methods=['PUT'])
+def heartbeat_handler():
+    """
+    heartbeat handler, keep a node registered and alive for another NODE_TTL seconds.
+    :return: Flask response
+    """
+    if not IS_CENTRAL_NODE:
+        return make_error_response("This is a common node, not provide Registry service.")
+    shard = request.args.get("shard", 0, type=int)
+    if shard not in SHARD_IDS:
+        return make_error_response("Unknown shard {}.".format(shard))
+    if request.method == 'PUT':
+        req = get_request_data()
+        if add_node(req.get("name"), req.get("address"), shard=shard):
+            return make_ok_response()
+        else:
+            return make_error_response("Heartbeat failed.")
+
+
+@app.route('/lease/', methods=['GET', 'PUT'])
+def lease_handler():
+    """
+    lease handler, action determine by http method
+    Lease is of "shard" in query string, each shard has its own leader.
+    If http method is "GET", will return holder of leader lease.
+    If http method is "PUT", will acquire leader lease for a node if no one holds it or renew it if the node holds it,
+        or release it if "release" is in body.
+    :return: Flask response, with lease, e.g. {"leader": "aaa", "address": "1.1.1.1:5000", "ttl": 0.8, "epoch": 3}
+    """
+    if not IS_CENTRAL_NODE:
+        return make_error_response("This is a common node, not provide Registry service.")
+    shard = request.args.get("shard", 0, type=int)
+    if shard not in SHARD_IDS:
+        return make_error_response("Unknown shard {}.".format(shard))
+    if request.method == 'GET':
+        holder, ttl, epoch = get_lease_from_redis(shard)
+    if request.method == 'PUT':
+        req = get_request_data()
+        name = req.get("name")
+        if req.get("release"):
+            drop_lease(name, shard)
+            return make_ok_response()
+        if get_node_address(name, shard) is None:
+            return make_error_response("Node {} is not registered.".format(name))
+        holder, ttl, epoch = hold_lease(name, float(req.get("ttl", LEADER_LEASE_TTL)), shard)
+    address = get_node_address(holder, shard) if holder else None
+    return make_json_response({"leader": holder, "address": address, "ttl": ttl / 1000, "epoch": epoch})
+
+
 @app.route('/leader/', methods=['GET'])
 def leader_handler():
     """
@@ -101,42 +455,274 @@ def data_handler():
     """
     data handler, action determine by http method
     If http method is "GET", will return all data that storing in this node.
+        With "limit" or "cursor" in query string, will return a page of data ordered by data_id and cursor of next page,
+        e.g. {"items": [{"data_id": "1", "raw": "a", "signature": "aaa"}], "next_cursor": "MQ=="}
+        With "format=ndjson" in query string, will stream all data, one json of data per line.
     If http method is "PUT", will receive a data and save it into db.
     :return: Flask response
     """
     if IS_CENTRAL_NODE:
         return make_error_response("This is a central node, not provide Data service.")
     if request.method == 'GET':
+        if request.args.get("format") == "ndjson":
+            def lines():
+                # streamed after handler returned, holds its own connection
+                with connection_context():
+                    for i in iter_all_data_from_db(DATA_STREAM_CHUNK_SIZE):
+                        yield json.dumps(i) + "\n"
+
+            return Response(lines(), mimetype="application/x-ndjson")
+        if "limit" in request.args or "cursor" in request.args:
+            try:
+                limit = parse_limit(request.args.get("limit"), DATA_PAGE_MAX_LIMIT)
+                cursor = request.args.get("cursor")
+                items = get_data_page(decode_cursor(cursor) if cursor else None, limit)
+            except ValueError as e:
+                return make_error_response("Invalid page: {}".format(e))
+            next_cursor = encode_cursor(items[-1]["data_id"]) if len(items) == limit else None
+            return make_json_response({"items": items, "next_cursor": next_cursor})
         return make_json_response(get_all_data_from_db())
     if request.method == 'PUT':
-        req = request.json
+        req = get_request_data()
 
         ret = validate_data(req)
 
         if not ret:
             return make_error_response("Validate data failed.")
 
-        req['data_id'] = req.get('id')
-        del req['id']
-        ret, msg = send_proposal(get_all_node().get(LEADER), req)
+        req = {"data_id": req.get("id"), "raw": req.get("raw"), "signature": req.get("signature")}
+        shard = ring.shard_of(req['data_id'])
+        ret, msg = send_proposal(shard_leader(shard), req)
+        if not ret and shard != SHARD_ID:
+            invalidate_shard_leader(shard)
         if ret:
             return make_ok_response()
         else:
             return make_error_response(msg)
 
 
+@app.route('/data/<data_id>', methods=['GET'])
+def data_item_handler(data_id):
+    """
+    data item handler, return a data by its data_id, data of another shard is read from leader of that shard.
+    :return: Flask response
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'GET':
+        shard = ring.shard_of(data_id)
+        if shard != SHARD_ID:
+            ret, msg = get_data_item(shard_leader(shard), data_id)
+            if ret is None:
+                invalidate_shard_leader(shard)
+            return make_json_response(msg) if ret else make_error_response(msg)
+        data = get_data_by_ids([data_id])[data_id]
+        if data is None:
+            return make_error_response("Data not found.")
+        return make_json_response(data)
+
+
+@app.route('/data/multi/', methods=['GET'])
+def data_multi_handler():
+    """
+    data multi handler, return data of all "id" in query string, e.g. /data/multi/?id=1&id=2
+    :return: Flask response, with data found in order of ids, and ids not found,
+        e.g. {"items": [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}], "missing": ["2"]}
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'GET':
+        data_ids = request.args.getlist("id")
+        if len(data_ids) > DATA_PAGE_MAX_LIMIT:
+            return make_error_response("Too many ids, at most {}.".format(DATA_PAGE_MAX_LIMIT))
+        found = get_data_by_ids(data_ids)
+        return make_json_response({"items": [found[i] for i in data_ids if found[i] is not None],
+                                   "missing": [i for i in data_ids if found[i] is None]})
+
+
+@app.route('/data/since/', methods=['GET'])
+def data_since_handler():
+    """
+    data since handler, return a page of data committed after "seq" in query string, ordered by seq.
+    Used by a restarting node to retrieve only data it missed.
+    :return: Flask response
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'GET':
+        try:
+            seq = int(request.args.get("seq", 0))
+            limit = parse_limit(request.args.get("limit"), DATA_PAGE_MAX_LIMIT)
+        except ValueError as e:
+            return make_error_response("Invalid page: {}".format(e))
+        return make_json_response(get_data_since(seq, limit))
+
+
+@app.route('/snapshot/', methods=['GET'])
+def snapshot_handler():
+    """
+    snapshot handler, stream all data with seq not greater than "seq" in query string as compressed chunks,
+        see snapshot.encode_chunk. Without "seq", snapshot is taken at high-water mark of this node.
+    With "cursor" in query string, only data after it are streamed, used to resume a broken transfer.
+    :return: Flask response
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'GET':
+        applied_seq = get_applied_seq()
+        try:
+            seq = int(request.args.get("seq", applied_seq))
+            cursor = request.args.get("cursor")
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return make_error_response("Invalid snapshot: {}".format(e))
+        if seq > applied_seq:
+            return make_error_response("Snapshot at seq {} is not available, applied seq is {}".format(seq,
+                                                                                                      applied_seq))
+
+        fmt = "msgpack" if wants_msgpack() else "json"
+
+        def chunks(after):
+            # streamed after handler returned, holds its own connection
+            with connection_context():
+                while True:
+                    data = get_snapshot_page(seq, after, SNAPSHOT_CHUNK_SIZE)
+                    if data:
+                        yield encode_chunk(seq, data, SNAPSHOT_COMPRESS_LEVEL, fmt)
+                    if len(data) < SNAPSHOT_CHUNK_SIZE:
+                        yield encode_end(seq)
+                        return
+                    after = data[-1]["data_id"]
+
+        return Response(chunks(after), mimetype="application/octet-stream")
+
+
+@app.route('/merkle/', methods=['GET'])
+def merkle_handler():
+    """
+    merkle handler, return root of merkle tree over data of this node,
+        or with "level" and "index" in query string, return children of these nodes of tree,
+        e.g. /merkle/?level=0&index=0 returns {"children": {"0": ["ab12...", ...]}}
+    :return: Flask response
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'GET':
+        if "level" not in request.args:
+            return make_json_response({"root": merkle_tree.root(), "buckets": merkle_tree.buckets,
+                                       "fanout": merkle_tree.fanout})
+        try:
+            level = int(request.args["level"])
+            indexes = [int(i) for i in request.args.getlist("index")]
+            if not 0 <= level < merkle_tree.depth:
+                raise ValueError("level out of range")
+            return make_json_response({"children": {str(i): merkle_tree.children(level, i) for i in indexes}})
+        except ValueError as e:
+            return make_error_response("Invalid merkle query: {}".format(e))
+
+
+@app.route('/merkle/bucket/', methods=['GET'])
+def merkle_bucket_handler():
+    """
+    merkle bucket handler, return all data in "bucket" of query string, and high-water mark read before them.
+    :return: Flask response,
+        e.g. {"applied_seq": 1, "data": [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]}
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'GET':
+        try:
+            buckets = [int(i) for i in request.args.getlist("bucket")]
+        except ValueError as e:
+            return make_error_response("Invalid bucket: {}".format(e))
+        applied_seq = get_applied_seq()
+        return make_json_response({"applied_seq": applied_seq, "data": get_data_in_buckets(buckets)})
+
+
+@app.route('/data/batch/', methods=['PUT'])
+def data_batch_handler():
+    """
+    data batch handler, receive a list of data and save them into db.
+    Data of several shards are split by shard and proposed to leader of each shard concurrently.
+    :return: Flask response, with result of each data, e.g. [{"data_id": "1", "result": "ok", "msg": null}]
+    """
+    if IS_CENTRAL_NODE:
+        return make_error_response("This is a central node, not provide Data service.")
+    if request.method == 'PUT':
+        req = get_request_data()
+
+        if not isinstance(req, list) or not all(isinstance(i, dict) for i in req):
+            return make_error_response("Validate data failed.")
+
+        data = [{"data_id": i.get("id"), "raw": i.get("raw"), "signature": i.get("signature")} for i in req]
+        # shard and indexes of its valid data, invalid data fail alone
+        groups = defaultdict(list)
+        for index, record in enumerate(data):
+            if validate_data(req[index]):
+                groups[ring.shard_of(record["data_id"])].append(index)
+        if len(groups) > 1 or len(data) > sum(len(i) for i in groups.values()):
+            results = propose_to_shards(data, groups)
+            return make_json_response([result or {"data_id": record["data_id"], "result": "error",
+                                                  "msg": "Validate data failed."}
+                                       for record, result in zip(data, results)])
+        shard = next(iter(groups), SHARD_ID)
+        ret, msg = send_batch_proposal(shard_leader(shard), data)
+        if not ret and shard != SHARD_ID:
+            invalidate_shard_leader(shard)
+        if ret:
+            return make_json_response(msg)
+        else:
+            return make_error_response(msg)
+
+
+def shard_leader(shard) -> str:
+    """
+    :return: address of leader of a shard, None if it's unknown
+    """
+    if shard == SHARD_ID:
+        return get_all_node().get(LEADER)
+    return get_shard_leader(shard)
+
+
+def propose_to_shards(data, groups) -> list:
+    """
+    Propose data of each shard to its leader concurrently.
+    :param data: data to propose
+    :param groups: shard and indexes of its data in data, e.g. {0: [0, 2], 1: [1]}
+    :return: result of each data in order, e.g. [{"data_id": "1", "result": "ok", "msg": null}]
+    """
+    leaders = {shard: shard_leader(shard) for shard in groups}
+    shards = {address: shard for shard, address in leaders.items() if address}
+
+    def propose(address):
+        return send_batch_proposal(address, [data[i] for i in groups[shards[address]]])
+
+    results, pending = fan_out(propose, {"shard:{}".format(shard): address for address, shard in shards.items()},
+                               timeout=PROPOSAL_TIMEOUT, executor=shard_executor)
+    ret = [None] * len(data)
+    for shard, indexes in groups.items():
+        ok, msg = results.get("shard:{}".format(shard), (False, "Leader of shard {} unavailable.".format(shard)))
+        if not ok:
+            if shard != SHARD_ID:
+                invalidate_shard_leader(shard)
+            msg = [{"data_id": data[i]["data_id"], "result": "error", "msg": msg} for i in indexes]
+        for i, result in zip(indexes, msg):
+            ret[i] = result
+    return ret
+
+
 @app.route('/prepare/', methods=['PUT'])
 def prepare_handler():
     """
-    prepare handler, will insert data to prepare db and return result.
+    prepare handler, will insert data of a transaction to prepare db and return result.
     :return: Flask response
     """
     if IS_CENTRAL_NODE:
         return make_error_response("This is a central node, not provide Data service.")
     if request.method == 'PUT':
         try:
-            req = request.json
-            ret = insert_data_to_prepare(req)
+            req = get_request_data()
+            ret = insert_data_to_prepare(req.get("data", []), req.get("txn_id", ""))
             if ret:
                 return make_ok_response()
             else:
@@ -148,14 +734,15 @@ def prepare_handler():
 @app.route('/submit/', methods=['PUT'])
 def submit_handler():
     """
-    submit handler, will move prepare data to data and return result.
+    submit handler, will move prepare data of a transaction to data and return result.
     :return: Flask response
     """
     if IS_CENTRAL_NODE:
         return make_error_response("This is a central node, not provide Data service.")
     if request.method == 'PUT':
         try:
-            ret = submit_prepare()
+            req = get_request_data(silent=True) or {}
+            ret = submit_prepare(req.get("txn_id", ""), req.get("first_seq"), req.get("last_seq"))
             if ret:
                 return make_ok_response()
             else:
@@ -167,15 +754,15 @@ def submit_handler():
 @app.route('/rollback/', methods=['PUT'])
 def rollback_handler():
     """
-    rollback handler, will delete prepare data.
+    rollback handler, will delete prepare data of a transaction.
     :return: Flask response
     """
     if IS_CENTRAL_NODE:
         return make_error_response("This is a central node, not provide Data service.")
     if request.method == 'PUT':
         try:
-            req = request.json
-            ret = del_prepare(req)
+            req = get_request_data()
+            ret = del_prepare(req.get("txn_id", ""), req.get("first_seq"), req.get("last_seq"))
             if ret:
                 return make_ok_response()
             else:
@@ -184,41 +771,83 @@ def rollback_handler():
             return make_error_response("rollback failed: {}".format(e))
 
 
+@app.route('/log/append/', methods=['PUT'])
+def log_append_handler():
+    """
+    log append handler, will append entries to replication log and return result.
+    :return: Flask response
+    """
+    if IS_CENTRAL_NODE or LOG is None:
+        return make_error_response("Replication log is not enabled on this node.")
+    if request.method == 'PUT':
+        try:
+            req = get_request_data()
+            entries = req.get("entries", [])
+            LOG.append(entries, sync=req.get("sync", True))
+            track_log_entries(entries)
+            return make_ok_response()
+        except Exception as e:
+            return make_error_response("log append failed: {}".format(e))
+
+
+@app.route('/log/since/', methods=['GET'])
+def log_since_handler():
+    """
+    log since handler, return a page of data committed after "seq" in query string from replication log.
+    :return: Flask response
+    """
+    if IS_CENTRAL_NODE or LOG is None:
+        return make_error_response("Replication log is not enabled on this node.")
+    if request.method == 'GET':
+        try:
+            seq = int(request.args.get("seq", 0))
+            limit = parse_limit(request.args.get("limit"), DATA_PAGE_MAX_LIMIT)
+            return make_json_response(LOG.committed_since(seq, limit))
+        except (ValueError, LookupError) as e:
+            return make_error_response("Invalid page: {}".format(e))
+
+
 @app.route('/proposal/', methods=['PUT'])
 def proposal_handler():
     """
     proposal handler, Leader only. Used to submit a proposal from client.
-    :return: Flask response
+    Proposal can be a data or a list of datas, proposals from all nodes are committed in groups.
+    :return: Flask response, with result of each data if proposal is a list.
     """
     if IS_CENTRAL_NODE:
         return make_error_response("This is a central node, not provide Data service.")
     if request.method == 'PUT':
-        req = request.json
-
-        ret = check_data_id_dup(req)
-        if not ret:
-            return make_error_response("dup id!")
-
-        ret, success = prepare(req)
-        if not ret:
-
-            ret = rollback(success, req)
+        req = get_request_data()
+        records = req if isinstance(req, list) else [req]
+        # an invalid record fails alone, never joins a commit round
+        valid = [validate_data(record, "data_id") for record in records]
+        if not isinstance(req, list) and not valid[0]:
+            return make_error_response("Validate data failed.")
 
+        if not holds_lease():
+            return make_error_response("Not leader.")
+        if any(ring.shard_of(record["data_id"]) != SHARD_ID for record, ok in zip(records, valid) if ok):
+            return make_error_response("Data of other shard.")
+
+        # only fields of data are committed, others would be carried into prepare and replication log
+        data = [{"data_id": record["data_id"], "raw": record["raw"], "signature": record["signature"]}
+                for record, ok in zip(records, valid) if ok]
+        with timer("dbs_proposal_seconds"):
+            committed = iter(committer.propose(data))
+        results = [next(committed) if ok else (False, "Validate data failed.") for ok in valid]
+        ok = sum(1 for ret, msg in results if ret)
+        inc("dbs_proposal_records_total", ok, result="ok")
+        inc("dbs_proposal_records_total", len(results) - ok, result="error")
+
+        if not isinstance(req, list):
+            ret, msg = results[0]
             if not ret:
-                return make_error_response("prepare failed, rollback success!")
-            else:
-                nodes = get_all_node()
-                for name in ret:
-                    kill_node(nodes[name])
-                return make_error_response("prepare failed, rollback failed!")
-
-        failed = submit()
-        if not ret:
-            return make_error_response("submit failed, failed list: {}".format(failed))
-        else:
-            make_ok_response()
+                return make_error_response(msg)
+            return make_ok_response()
 
-        return make_ok_response()
+        return make_json_response([{"data_id": record.get("data_id") if isinstance(record, dict) else None,
+                                    "result": "ok" if ret else "error", "msg": msg}
+                                   for record, (ret, msg) in zip(req, results)])
 
 
 @app.route('/ping/', methods=['GET'])
@@ -231,6 +860,16 @@ def ping_handler():
         return make_json_response({"name": NODE_NAME, "address": NODE_ADDRESS})
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    """
+    metrics handler, will return counters and latency histograms of this node in prometheus text format.
+    :return: Flask response
+    """
+    if request.method == 'GET':
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/kill/', methods=['GET'])
 def kill_handler():
     """
@@ -240,6 +879,8 @@ def kill_handler():
     if request.method == 'GET':
         global STOP
         STOP = True
+        if LEADER_LEASE_ENABLED and LEADER == NODE_NAME:
+            release_lease()
         os.kill(os.getpid(), signal.SIGINT)
         return make_ok_response()
 
@@ -251,13 +892,31 @@ def check_node(name, address) -> bool:
     :param address: node's address
     :return: is node alive
     """
-    alive = ping(address)
-    print(name, address, "is alive:", alive)
+    alive, latency = timed_ping(address)
+    NODE_LATENCY[name] = latency
     if not alive:
         print("Node {}({}) is gone".format(name, address))
     return alive
 
 
+def check_nodes(nodes) -> dict:
+    """
+    check nodes concurrently, node not answered in time is treated as dead.
+    :param nodes: nodes to check, e.g. {"aaa": "1.1.1.1:5000"}
+    :return: dict of node's name and is it alive
+    """
+    results, pending = fan_out(timed_ping, nodes, timeout=HEALTH_CHECK_TIMEOUT)
+    alive = {name: False for name in pending}
+    for name, (ret, latency) in results.items():
+        NODE_LATENCY[name] = latency
+        alive[name] = ret
+    # latency of each node is exported by dbs_node_latency_seconds, only gone nodes are logged
+    for name, ret in alive.items():
+        if not ret:
+            print("Node {}({}) is gone".format(name, nodes[name]))
+    return alive
+
+
 def vote_leader() -> (str, str):
     """
     Used to vote leader, will return name and address of leader.
@@ -300,6 +959,7 @@ def vote_leader() -> (str, str):
 
         global LEADER
         LEADER = leader
+        inc("dbs_elections_total")
 
         time.sleep(1)
 
@@ -308,7 +968,7 @@ def leader_checker():
     """
     Running in common node, used to check if leader node is alive or will vote for new one.
     """
-    global STOP
+    global STOP, CAUGHT_UP
     leader_name = None
     leader_address = None
     while not STOP:
@@ -319,62 +979,455 @@ def leader_checker():
         else:
             global LEADER
             LEADER = leader_name
+            if LEADER != NODE_NAME:
+                # reload from db and catch up next time this node becomes leader
+                CAUGHT_UP = False
+                sequencer.reset()
         time.sleep(NODE_CHECK_INTERVAL)
 
 
+def successor_rank(nodes, excluded) -> int:
+    """
+    Get rank of this node in order of election, same as the order vote_leader picks leader.
+    :param nodes: all nodes, e.g. {"aaa": "1.1.1.1:5000"}
+    :param excluded: name of node can't be leader, e.g. the one just lost its lease
+    :return: 0 if this node is the first to be leader
+    """
+    order = [name for name, address in sorted(nodes.items(), key=lambda i: (len(i[1]), i[0]), reverse=True)
+             if name != excluded]
+    return order.index(NODE_NAME) if NODE_NAME in order else len(order)
+
+
+def follow_lease(lease, start):
+    """
+    Take holder of lease as leader.
+    :param lease: lease read or acquired, e.g. {"leader": "aaa", "address": "1.1.1.1:5000", "ttl": 0.8, "epoch": 3}
+    :param start: monotonic time before lease was requested, lease is surely held until ttl after it
+    """
+    global LEADER, LEASE_EXPIRE, CAUGHT_UP
+    leader = lease["leader"] or None
+    if leader == NODE_NAME:
+        LEASE_EXPIRE = start + lease["ttl"]
+    if leader != LEADER:
+        print("Leader changed: {} -> {}, epoch {}".format(LEADER, leader, lease["epoch"]))
+        # old leader may be gone, revalidate node list at once
+        invalidate_node_cache()
+        if leader:
+            inc("dbs_elections_total")
+    LEADER = leader
+    if LEADER != NODE_NAME:
+        # reload from db and catch up next time this node becomes leader
+        CAUGHT_UP = False
+        sequencer.reset()
+
+
+def lease_keeper():
+    """
+    Running in common node if leader lease is enabled, used to renew lease if this node is leader,
+        or follow the node holding lease.
+    When lease is expired, nodes try to acquire it in order of election, see successor_rank,
+        so the next node takes over at once and others only if it fails to.
+    """
+    global LEADER
+    last_leader = None
+    vacant_since = None
+    while not STOP:
+        start = time.monotonic()
+        if LEADER == NODE_NAME:
+            lease = acquire_lease(LEADER_LEASE_TTL, timeout=LEADER_LEASE_TTL / 2)
+        else:
+            lease = get_lease()
+            if lease is not None and not lease["leader"]:
+                vacant_since = vacant_since or start
+                if start - vacant_since >= successor_rank(get_all_node(), last_leader) * LEADER_LEASE_BACKOFF:
+                    lease = acquire_lease(LEADER_LEASE_TTL, timeout=LEADER_LEASE_TTL / 2)
+        if lease is not None:
+            if lease["leader"]:
+                vacant_since = None
+                last_leader = lease["leader"]
+            follow_lease(lease, start)
+        elif LEADER == NODE_NAME and time.monotonic() >= LEASE_EXPIRE:
+            # central node is unreachable, lease can't be renewed
+            print("Leader lease expired, step down")
+            LEADER = None
+        interval = LEADER_LEASE_RENEW_INTERVAL if LEADER == NODE_NAME else LEADER_LEASE_CHECK_INTERVAL
+        time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+
 def node_checker():
     """
     Running in central node, used to check if there's dead node in all registered node,
         and remove it from registered node if it's.
+    If heartbeat is enabled, a node is dead when its heartbeat expired, no node is polled.
+    Nodes of all shards are checked.
     """
     global STOP
     while not STOP:
-        nodes = get_all_nodes_from_redis()
-        for name, address in nodes.items():
-            print("Checking node {}({})".format(name, address))
-            if not check_node(name, address):
-                del_node(name)
+        if HEARTBEAT_ENABLED:
+            for shard in SHARD_IDS:
+                for name in expire_nodes(shard):
+                    print("Node {} of shard {} is gone, no heartbeat".format(name, shard))
+                    NODE_LATENCY.pop(name, None)
+            time.sleep(HEARTBEAT_INTERVAL)
+            continue
+        for shard in SHARD_IDS:
+            nodes = get_registered_nodes(shard)
+            for name, alive in check_nodes(nodes).items():
+                if not alive:
+                    del_node(name, shard)
+                    NODE_LATENCY.pop(name, None)
         time.sleep(NODE_CHECK_INTERVAL)
 
 
+def heartbeater():
+    """
+    Running in common node, used to send heartbeat to central node to keep this node registered.
+    """
+    global STOP
+    while not STOP:
+        send_heartbeat()
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def membership_watcher():
+    """
+    Running in common node if membership watch is enabled, used to keep node list up to date with changes
+        pushed by central node, so node list is not polled. Polling takes over while central node is unreachable
+        or holds too many watches.
+    """
+    while not STOP:
+        if not watch_node_cache():
+            time.sleep(MEMBERSHIP_CACHE_TTL)
+
+
+def bootstrap(address) -> int:
+    """
+    Receive a snapshot from a node, resuming the one partly received before if there is.
+    Each chunk is applied with progress in one transaction, a broken transfer resumes after last applied chunk.
+    :param address: address of node
+    :return: seq of snapshot, raise if transfer failed.
+    """
+    seq, cursor = get_snapshot_progress()
+    if seq is not None:
+        print("resume snapshot at seq {} after {}".format(seq, cursor))
+    try:
+        for header, data in iter_snapshot_chunks(address, seq, cursor):
+            if header.get("end"):
+                finish_snapshot(header["seq"])
+                return header["seq"]
+            apply_snapshot_chunk(data, header["seq"], header["cursor"])
+    except LookupError:
+        # node can't serve the snapshot we were receiving, e.g. it's a new leader lags behind, start over
+        clear_snapshot_progress()
+        raise
+
+
+def pull_since(address, seq, from_log=False) -> int:
+    """
+    Retrieve data committed after given seq from a node and save them page by page.
+    :param address: address of node
+    :param seq: only data with greater seq are retrieved
+    :param from_log: read from replication log of node instead of its db
+    :return: max seq of data retrieved, given seq if nothing retrieved
+    """
+    path = '/log/since/' if from_log else '/data/since/'
+    max_seq = seq
+    for page in iter_data_since(address, seq, path=path):
+        insert_data(page)
+        max_seq = max([max_seq] + [i["seq"] for i in page if i.get("seq")])
+    return max_seq
+
+
+def catch_up(address, seq) -> int:
+    """
+    Retrieve data committed after given seq from a node, from its replication log if it's enabled,
+        or from its db if log has been truncated.
+    :return: max seq of data retrieved, given seq if nothing retrieved
+    """
+    if REPLICATION_LOG_ENABLED:
+        try:
+            return pull_since(address, seq, from_log=True)
+        except Exception as e:
+            print("catch up from log of {} failed: {}, try its db".format(address, e))
+    return pull_since(address, seq)
+
+
+def catch_up_as_leader() -> bool:
+    """
+    Used in majority policy before this node commits anything as leader. Data committed by a quorum may be missed
+        by this node, so it retrieves data from all nodes first, a majority of them have all data committed between.
+    :return: if it has caught up with a majority of nodes
+    """
+    global CAUGHT_UP
+    with CATCH_UP_LOCK:
+        if CAUGHT_UP:
+            return True
+        nodes = get_all_node()
+        with connection_context():
+            applied_seq = max_seq = get_applied_seq()
+            caught_up = [NODE_NAME]
+            for name, address in nodes.items():
+                if name == NODE_NAME:
+                    continue
+                try:
+                    max_seq = max(max_seq, catch_up(address, applied_seq))
+                    caught_up.append(name)
+                except Exception as e:
+                    print("catch up from {} failed: {}".format(name, e))
+            if len(caught_up) < len(nodes) // 2 + 1:
+                return False
+            set_applied_seq(max_seq)
+            del_settled_prepare(max_seq)
+        print("caught up with {} as leader, applied seq {} -> {}".format(caught_up, applied_seq, max_seq))
+        CAUGHT_UP = True
+        return True
+
+
+def catch_up_checker():
+    """
+    Running in common node in majority policy, used to catch up with leader if this node is left behind by quorum.
+    High-water mark of such node stops rising at the first transaction it missed, so it catches up whenever
+        its high-water mark didn't rise in last CATCH_UP_INTERVAL seconds, that's a check of nothing if it's idle.
+    """
+    last_seq = None
+    while not STOP:
+        time.sleep(CATCH_UP_INTERVAL)
+        address = get_all_node().get(LEADER) if LEADER and LEADER != NODE_NAME else None
+        if not address:
+            last_seq = None
+            continue
+        try:
+            with connection_context():
+                applied_seq = get_applied_seq()
+                if applied_seq == last_seq:
+                    max_seq = catch_up(address, applied_seq)
+                    set_applied_seq(max_seq)
+                    del_settled_prepare(max_seq)
+                    if max_seq > applied_seq:
+                        inc("dbs_catch_up_total")
+                        print("caught up with {}, applied seq {} -> {}".format(address, applied_seq, max_seq))
+                    applied_seq = max_seq
+                last_seq = applied_seq
+        except Exception as e:
+            print("catch up with {} failed: {}".format(address, e))
+
+
 def syncer():
     """
     Running in common node, we assume when a node start, it has no or old data, needs to retrieve from leader.
+    If this node has no high-water mark, a snapshot of leader is received first, see bootstrap.
+    Then data committed after high-water mark are read from leader's replication log if it's enabled, or from its db.
+    Data is retrieved and saved page by page, will start over if any page failed.
+    A full copy walking leader's data in data_id order is not used, a data committed with a smaller data_id
+        during the walk would be missed for good, snapshot at a fixed seq replaced it.
     """
+    from_log = REPLICATION_LOG_ENABLED
     while True:
         if not LEADER:
             time.sleep(1)
             continue
         address = get_all_node().get(LEADER, "")
         if address:
-            data = get_all_data(address)
-            insert_data(data)
-            return
+            applied_seq = 0
+            start = time.perf_counter()
+            try:
+                with connection_context():
+                    applied_seq = get_applied_seq()
+                    if not applied_seq:
+                        applied_seq = bootstrap(address)
+                        observe("dbs_sync_seconds", time.perf_counter() - start, source="snapshot")
+                        print("snapshot from {} at seq {} received".format(address, applied_seq))
+                    source = "log" if from_log else "db"
+                    max_seq = pull_since(address, applied_seq, from_log)
+                    set_applied_seq(max_seq)
+                    observe("dbs_sync_seconds", time.perf_counter() - start, source=source)
+                    print("synced from {}, applied seq {} -> {}".format(address, applied_seq, max_seq))
+                    return
+            except Exception as e:
+                print("sync from {} failed: {}".format(address, e))
+                if from_log and applied_seq:
+                    # leader's log may be truncated, try its db then
+                    from_log = False
+                    continue
+                time.sleep(1)
+
+
+def anti_entropy(address) -> (int, int):
+    """
+    Compare merkle tree of this node with a node's from root down, and repair buckets differ with its data.
+    :param address: address of node
+    :return: count of data inserted or replaced, and count of data deleted
+    """
+    remote = get_merkle(address)
+    if (remote["buckets"], remote["fanout"]) != (merkle_tree.buckets, merkle_tree.fanout):
+        raise Exception("merkle tree of {} is not comparable: {}".format(address, remote))
+    if remote["root"] == merkle_tree.root():
+        return 0, 0
+    diff = [0]
+    for level in range(merkle_tree.depth):
+        children = {}
+        for i in range(0, len(diff), ANTI_ENTROPY_BATCH):
+            children.update(get_merkle(address, level, diff[i:i + ANTI_ENTROPY_BATCH])["children"])
+        diff = [index * merkle_tree.fanout + k for index in diff
+                for k, (mine, theirs) in enumerate(zip(merkle_tree.children(level, index), children[str(index)]))
+                if mine != theirs]
+    upserted = deleted = 0
+    for i in range(0, len(diff), ANTI_ENTROPY_BATCH):
+        buckets = diff[i:i + ANTI_ENTROPY_BATCH]
+        r = get_buckets(address, buckets)
+        u, d = repair_buckets(buckets, r["data"], r["applied_seq"])
+        upserted, deleted = upserted + u, deleted + d
+    print("anti entropy with {}: {} buckets differ, {} data repaired, {} data deleted".format(
+        address, len(diff), upserted, deleted))
+    return upserted, deleted
+
+
+def anti_entropy_checker():
+    """
+    Running in common node, used to repair data diverged from leader's periodically.
+    """
+    while not STOP:
+        time.sleep(ANTI_ENTROPY_INTERVAL)
+        address = get_all_node().get(LEADER) if LEADER and LEADER != NODE_NAME else None
+        if not address:
+            continue
+        try:
+            with timer("dbs_anti_entropy_seconds"), connection_context():
+                upserted, deleted = anti_entropy(address)
+            inc("dbs_anti_entropy_repaired_total", upserted, op="upsert")
+            inc("dbs_anti_entropy_repaired_total", deleted, op="delete")
+        except Exception as e:
+            print("anti entropy with {} failed: {}".format(address, e))
+
+
+def track_log_entries(entries):
+    """
+    Track data_ids of transactions prepared in replication log and data_ids committed but not applied yet.
+    :param entries: entries appended to log, in order
+    """
+    for entry in entries:
+        if entry["type"] == "prepare":
+            LOG_TXNS[entry["txn_id"]] = [i["data_id"] for i in entry["data"]]
+        elif entry["type"] == "commit":
+            UNAPPLIED_IDS.update(LOG_TXNS.pop(entry["txn_id"], []))
+        else:
+            LOG_TXNS.pop(entry["txn_id"], None)
+
+
+def load_log_entries():
+    """
+    Track entries of replication log not applied to db yet, after restart they are only on disk.
+    Must be done before log applier starts and before this node accepts proposals,
+        or leader may accept a data_id committed in log but not in db yet.
+    """
+    with connection_context():
+        index = get_log_applied_index()
+    track_log_entries(LOG.read(index))
+    print("replication log: {} transactions prepared, {} data_ids not applied after index {}".format(
+        len(LOG_TXNS), len(UNAPPLIED_IDS), index))
+
+
+def log_applier():
+    """
+    Running in common node with replication log, apply committed entries of log to db in order.
+    Applied index is saved as the one before the earliest entry still waiting for commit,
+        so applier restarts from there and applies again idempotently.
+    """
+    prepared = {}
+    index = checkpoint = get_log_applied_index()
+    while not STOP:
+        try:
+            with connection_context():
+                for entry in LOG.read(index):
+                    if entry["type"] == "prepare":
+                        prepared[entry["txn_id"]] = (entry["index"], time.time(), entry["data"])
+                    elif entry["type"] == "commit":
+                        _, _, data = prepared.pop(entry["txn_id"], (None, None, []))
+                        if data:
+                            apply_data(data, entry["first_seq"], entry["last_seq"])
+                            UNAPPLIED_IDS.difference_update(i["data_id"] for i in data)
+                    else:
+                        prepared.pop(entry["txn_id"], None)
+                        if entry.get("first_seq") is not None:
+                            # seq of aborted transaction are skipped
+                            apply_data([], entry["first_seq"], entry["last_seq"])
+                    index = entry["index"]
+                for txn_id, (_, seen, _) in list(prepared.items()):
+                    if time.time() - seen > REPLICATION_LOG_PREPARE_EXPIRE:
+                        print("replication log: drop expired prepare {}".format(txn_id))
+                        del prepared[txn_id]
+                applied = min([i for i, _, _ in prepared.values()], default=index + 1) - 1
+                if applied != checkpoint:
+                    set_log_applied_index(applied)
+                    LOG.truncate(applied)
+                    checkpoint = applied
+        except Exception as e:
+            print("replication log: apply after {} failed: {}".format(index, e))
+            time.sleep(1)
+        LOG.wait(index, 1)
+
+
+def serve():
+    """
+    Run api server, flask's development server or a production one according to SERVER_MODE.
+    Production server accepts up to SERVER_CONNECTION_LIMIT connections asynchronously,
+        and runs handlers in SERVER_THREADS threads, so proposals waiting on leader don't block accepting clients.
+    """
+    if SERVER_MODE == "waitress":
+        from waitress import serve as waitress_serve
+        waitress_serve(app, host="0.0.0.0", port=NODE_PORT, threads=SERVER_THREADS,
+                       connection_limit=SERVER_CONNECTION_LIMIT, backlog=SERVER_BACKLOG,
+                       channel_timeout=SERVER_CHANNEL_TIMEOUT, asyncore_use_poll=True, ident="DBS")
+    else:
+        app.run(host="0.0.0.0", port=NODE_PORT, debug=False, threaded=True)
 
 
 if __name__ == '__main__':
 
+    if not IS_CENTRAL_NODE:
+        with connection_context():
+            init_db()
+
+    if not IS_CENTRAL_NODE and REPLICATION_LOG_ENABLED:
+        LOG = ReplicationLog(REPLICATION_LOG_PATH, REPLICATION_LOG_SEGMENT_BYTES, REPLICATION_LOG_RETAIN_SEGMENTS)
+        load_log_entries()
+        threading.Thread(target=log_applier, daemon=True).start()
+
     # if this is common node and register failed that exit.
     if not IS_CENTRAL_NODE and not register():
         print("Register failed! exiting...")
         exit(-1)
 
-    api_thread = threading.Thread(target=lambda: app.run(host="0.0.0.0", port=NODE_PORT, debug=False))
+    api_thread = threading.Thread(target=serve)
     api_thread.start()
 
     if IS_CENTRAL_NODE:
         target = node_checker
+    elif LEADER_LEASE_ENABLED:
+        target = lease_keeper
     else:
         target = leader_checker
 
-    # run leader_check in common node or node_checker in central node.
+    # run leader_checker or lease_keeper in common node, or node_checker in central node.
     t = threading.Thread(target=target)
     t.start()
 
+    if not IS_CENTRAL_NODE and HEARTBEAT_ENABLED:
+        threading.Thread(target=heartbeater, daemon=True).start()
+
+    if not IS_CENTRAL_NODE and MEMBERSHIP_WATCH_ENABLED:
+        threading.Thread(target=membership_watcher, daemon=True).start()
+
+    if not IS_CENTRAL_NODE and ANTI_ENTROPY_ENABLED:
+        threading.Thread(target=anti_entropy_checker, daemon=True).start()
+
     if not IS_CENTRAL_NODE:
         # when start a node, sync data from leader before start api server.
         sync = threading.Thread(target=syncer)
         sync.start()
         sync.join()
 
+    if not IS_CENTRAL_NODE and COMMIT_POLICY == "majority":
+        threading.Thread(target=catch_up_checker, daemon=True).start()
+
     api_thread.join()
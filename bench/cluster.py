@@ -0,0 +1,179 @@
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from bench.proxy import DelayProxy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run app.py as __main__ with node's own config.py ahead of repo on sys.path
+BOOT = "import runpy, sys; sys.path[:0] = [sys.argv[1], sys.argv[2]]; runpy.run_path(sys.argv[3], run_name='__main__')"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Node:
+    """
+    A node process of a local cluster, with its own directory holding config, db, replication log and output.
+    With a proxy, node is registered by address of proxy, so rpc from peers can be delayed by proxy.
+    """
+
+    def __init__(self, name, root, overrides, proxy=False):
+        self.name = name
+        self.shard = overrides.get("SHARD_ID", 0)
+        self.port = free_port()
+        self.proxy = DelayProxy(self.port, 0).start() if proxy else None
+        self.address = "127.0.0.1:{}".format(self.proxy.port if proxy else self.port)
+        self.dir = os.path.join(root, name)
+        self.process = None
+        os.makedirs(self.dir, exist_ok=True)
+        overrides = dict(overrides, NODE_NAME=name, NODE_PORT=self.port, NODE_ADDRESS=self.address)
+        overrides.setdefault("db_config", {"engine": "sqlite", "db_name": os.path.join(self.dir, "data.db"),
+                                           "pool": {"max_connections": 32, "stale_timeout": 300, "timeout": 10}})
+        overrides.setdefault("REPLICATION_LOG_PATH", os.path.join(self.dir, "replication_log"))
+        with open(os.path.join(ROOT, "config_template.py")) as f:
+            template = f.read()
+        with open(os.path.join(self.dir, "config.py"), "w") as f:
+            f.write(template + "\n# overridden by bench\n")
+            f.write("".join("{} = {!r}\n".format(k, v) for k, v in overrides.items()))
+
+    def start(self):
+        log = open(os.path.join(self.dir, "output.log"), "ab")
+        self.process = subprocess.Popen([sys.executable, "-c", BOOT, self.dir, ROOT, os.path.join(ROOT, "app.py")],
+                                        cwd=self.dir, stdout=log, stderr=subprocess.STDOUT)
+
+    def kill(self):
+        """
+        Kill node without any chance to clean up, like a crash.
+        """
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGKILL)
+            self.process.wait()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def url(self, path) -> str:
+        return "http://127.0.0.1:{}{}".format(self.port, path)
+
+    def get(self, path, **kwargs):
+        return requests.get(self.url(path), timeout=kwargs.pop("timeout", 5), **kwargs).json()
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.alive:
+                raise RuntimeError("node {} exited, see {}".format(self.name, os.path.join(self.dir, "output.log")))
+            try:
+                if self.get("/ping/", timeout=1).get("result") == "ok":
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise TimeoutError("node {} not ready in {}s".format(self.name, timeout))
+
+    def leader(self) -> str:
+        try:
+            return self.get("/leader/", timeout=1).get("data", {}).get("leader") or ""
+        except requests.RequestException:
+            return ""
+
+    def count(self) -> int:
+        """
+        Count data stored in node by streaming all of them.
+        """
+        r = requests.get(self.url("/data/?format=ndjson"), stream=True, timeout=30)
+        return sum(1 for line in r.iter_lines() if line)
+
+
+class Cluster:
+    """
+    A central node and common nodes running on this machine, with sqlite as db and in process fake redis,
+        used by benchmark and tests.
+    """
+
+    def __init__(self, nodes=3, overrides=None, root=None, proxy=False, shards=1):
+        """
+        :param nodes: count of common nodes of each shard
+        :param overrides: config overrides applied to all nodes, e.g. {"GROUP_COMMIT_LINGER": 0.01}
+        :param root: directory of nodes, a temp directory removed on stop if not given
+        :param proxy: put a DelayProxy in front of each common node, to slow it down later
+        :param shards: count of shards, nodes are assigned to them round robin
+        """
+        self._own_root = root is None
+        self.root = root or tempfile.mkdtemp(prefix="dbs-bench-")
+        self.shards = list(range(shards))
+        overrides = dict({"NODE_CHECK_INTERVAL": 1, "HEARTBEAT_INTERVAL": 0.5, "NODE_TTL": 2, "SHARD_IDS": self.shards},
+                         **(overrides or {}))
+        self.central = Node("central", self.root, dict(overrides, IS_CENTRAL_NODE=True,
+                                                       REDIS_CONFIG={"fake": True}))
+        overrides = dict(overrides, IS_CENTRAL_NODE=False, CENTRAL_NODE_ADDRESS=self.central.address)
+        self.nodes = [Node("node{}".format(i), self.root, dict(overrides, SHARD_ID=i % shards), proxy)
+                      for i in range(nodes * shards)]
+
+    def start(self, timeout=60):
+        self.central.start()
+        self.central.wait_ready(timeout)
+        for node in self.nodes:
+            node.start()
+        for node in self.nodes:
+            node.wait_ready(timeout)
+        for shard in self.shards:
+            self.wait_leader(timeout, shard=shard)
+        return self
+
+    def stop(self):
+        for node in self.nodes + [self.central]:
+            node.kill()
+            if node.proxy:
+                node.proxy.stop()
+        if self._own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def alive_nodes(self, shard=None) -> [Node]:
+        """
+        :param shard: only nodes of this shard if given
+        """
+        return [node for node in self.nodes if node.alive and shard in (None, node.shard)]
+
+    def node(self, name) -> Node:
+        return next(node for node in self.nodes if node.name == name)
+
+    def followers(self, shard=0) -> [Node]:
+        leader = self.wait_leader(shard=shard)
+        return [node for node in self.alive_nodes(shard) if node is not leader]
+
+    def wait_leader(self, timeout=60, exclude=None, shard=0) -> Node:
+        """
+        Wait until all alive nodes of a shard agree on a leader.
+        :param exclude: name of a node which can't be leader, e.g. a killed one
+        :param shard: shard of leader
+        :return: leader node
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            leaders = {node.leader() for node in self.alive_nodes(shard)}
+            if len(leaders) == 1:
+                leader = leaders.pop()
+                if leader and leader != exclude:
+                    return self.node(leader)
+            time.sleep(0.05)
+        raise TimeoutError("no leader agreed in {}s".format(timeout))
@@ -0,0 +1,64 @@
+import socket
+import threading
+import time
+
+
+class DelayProxy:
+    """
+    TCP proxy in front of a local port, every chunk sent through it is delayed, like a slow or far away node.
+    Peers reach a slow node through its proxy, while benchmark talks to the node directly.
+    """
+
+    def __init__(self, target_port, delay):
+        """
+        :param target_port: port of node behind proxy
+        :param delay: seconds every chunk is delayed in each direction
+        """
+        self.target_port = target_port
+        self.delay = delay
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(128)
+        self.port = self._server.getsockname()[1]
+        self._stopped = False
+
+    def start(self) -> "DelayProxy":
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._server.close()
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            try:
+                upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            except OSError:
+                # node is down, refuse like it would
+                client.close()
+                continue
+            threading.Thread(target=self._pipe, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self._pipe, args=(upstream, client), daemon=True).start()
+
+    def _pipe(self, source, target):
+        try:
+            while True:
+                chunk = source.recv(65536)
+                if not chunk:
+                    break
+                time.sleep(self.delay)
+                target.sendall(chunk)
+        except OSError:
+            pass
+        finally:
+            for s in (source, target):
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
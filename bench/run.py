@@ -0,0 +1,251 @@
+"""
+Benchmark of a local DBS cluster, run from root of repo:
+
+    python -m bench.run --nodes 3 --requests 2000 --concurrency 32
+
+It starts a central node and common nodes on this machine with sqlite and fake redis, then reports
+throughput and latency percentiles of writes, page reads and point reads, time to fail over after leader is killed,
+and time for the killed node to sync after restart.
+
+With --slow-delay or --kill-followers, writes are measured again with some followers slowed down or killed,
+then time until all nodes have the same data. Compare COMMIT_POLICY "all" and "majority" by --config:
+
+    python -m bench.run --slow-delay 50 --kill-followers 1 --config '{"COMMIT_POLICY": "majority"}'
+
+With --shards, key space is split into shards of --nodes nodes each, and writes are sent to all nodes round robin,
+which forward them to leader of the shard owns the data. Compare write throughput of 1 and 2 shards:
+
+    python -m bench.run --nodes 2 --shards 2 --no-failover
+"""
+import argparse
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.cluster import Cluster
+
+
+def percentile(values, p) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(name, latencies, errors, elapsed, records=None) -> dict:
+    return {
+        "phase": name,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput": (records or len(latencies)) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "p999_ms": percentile(latencies, 99.9) * 1000,
+    }
+
+
+def drive(name, nodes, requests_count, concurrency, make_request, records_per_request=1) -> dict:
+    """
+    Send requests to nodes round robin at given concurrency.
+    :param make_request: function send one request to a node, returns if it succeeded
+    """
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def one(i):
+        node = nodes[i % len(nodes)]
+        start = time.perf_counter()
+        try:
+            ok = make_request(session, node, i)
+        except requests.RequestException:
+            ok = False
+        return ok, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(one, range(requests_count)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for ok, latency in results if ok]
+    return summarize(name, latencies, len(results) - len(latencies), elapsed,
+                     len(latencies) * records_per_request)
+
+
+def record(prefix, i) -> dict:
+    return {"id": "{}-{}".format(prefix, i), "raw": "x" * 64, "signature": "s" * 32}
+
+
+def put_one(prefix):
+    def make_request(session, node, i):
+        r = session.put(node.url("/data/"), json=record(prefix, i), timeout=30).json()
+        return r.get("result") == "ok"
+    return make_request
+
+
+def put_batch(prefix, size):
+    def make_request(session, node, i):
+        r = session.put(node.url("/data/batch/"), json=[record(prefix, i * size + j) for j in range(size)],
+                        timeout=60).json()
+        return r.get("result") == "ok" and all(i["result"] == "ok" for i in r["data"])
+    return make_request
+
+
+def get_page(session, node, i):
+    return session.get(node.url("/data/?limit=100"), timeout=30).json().get("result") == "ok"
+
+
+def get_one(prefix, count):
+    def make_request(session, node, i):
+        # a tenth of written data are hot, read most of the time
+        j = i % max(1, count // 10) if i % 10 else i % count
+        return session.get(node.url("/data/{}-{}".format(prefix, j)), timeout=30).json().get("result") == "ok"
+    return make_request
+
+
+def measure_failover(cluster, prefix) -> dict:
+    """
+    Kill leader and measure time until a write through another node succeeds.
+    """
+    leader = cluster.wait_leader()
+    others = [node for node in cluster.alive_nodes(leader.shard) if node is not leader]
+    leader.kill()
+    start = time.perf_counter()
+    i = 0
+    while True:
+        i += 1
+        try:
+            r = requests.put(others[i % len(others)].url("/data/"), json=record(prefix, i), timeout=5).json()
+            if r.get("result") == "ok":
+                break
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    return {"phase": "failover", "killed": leader.name, "seconds": time.perf_counter() - start}
+
+
+def measure_sync(cluster, name) -> dict:
+    """
+    Restart a killed node and measure time until it has as many data as leader.
+    """
+    node = cluster.node(name)
+    start = time.perf_counter()
+    node.start()
+    node.wait_ready()
+    expected = cluster.wait_leader(exclude=name, shard=node.shard).count()
+    while node.count() < expected:
+        time.sleep(0.05)
+    return {"phase": "sync", "node": name, "data": expected, "seconds": time.perf_counter() - start}
+
+
+def measure_degraded(cluster, name, followers, requests_count, concurrency, prefix, slow_delay=0) -> dict:
+    """
+    Slow down or kill given followers, and measure writes through leader and other followers.
+    :param slow_delay: seconds every chunk to followers is delayed, they are killed if it's 0
+    """
+    for node in followers:
+        if slow_delay:
+            node.proxy.delay = slow_delay
+        else:
+            node.kill()
+    nodes = [node for node in cluster.alive_nodes() if node not in followers]
+    try:
+        return drive(name, nodes, requests_count, concurrency, put_one(prefix))
+    finally:
+        for node in followers:
+            if slow_delay:
+                node.proxy.delay = 0
+            else:
+                node.start()
+                node.wait_ready()
+
+
+def measure_converge(cluster, timeout=120) -> dict:
+    """
+    Measure time until all alive nodes have as many data as leader of their shard, e.g. nodes left behind catch up.
+    """
+    start = time.perf_counter()
+    expected = {shard: cluster.wait_leader(shard=shard).count() for shard in cluster.shards}
+    converged = False
+    while not converged and time.perf_counter() - start < timeout:
+        converged = all(node.count() == expected[node.shard] for node in cluster.alive_nodes())
+        if not converged:
+            time.sleep(0.2)
+    return {"phase": "converge", "data": sum(expected.values()), "converged": converged,
+            "seconds": time.perf_counter() - start}
+
+
+def measure_phases(leader) -> dict:
+    """
+    Read mean latency of each phase of leader from its metrics.
+    """
+    sums, counts = {}, {}
+    for line in requests.get(leader.url("/metrics"), timeout=5).text.splitlines():
+        for suffix, values in (("_sum", sums), ("_count", counts)):
+            prefix = "dbs_phase_seconds{}{{phase=\"".format(suffix)
+            if line.startswith(prefix):
+                phase, value = line[len(prefix):].split('"} ')
+                values[phase] = float(value)
+    result = {"phase": "leader_phases"}
+    for phase, count in sorted(counts.items()):
+        result["{}_ms".format(phase)] = sums[phase] / count * 1000 if count else 0.0
+    return result
+
+
+def report(results):
+    for r in results:
+        if "throughput" in r:
+            print("{phase:<14} requests={requests:<6} errors={errors:<4} throughput={throughput:9.1f}/s "
+                  "p50={p50_ms:8.2f}ms p99={p99_ms:8.2f}ms p999={p999_ms:8.2f}ms".format(**r))
+        else:
+            print("{:<14} {}".format(r["phase"], " ".join("{}={}".format(k, round(v, 3) if isinstance(v, float) else v)
+                                                          for k, v in r.items() if k != "phase")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a local DBS cluster.")
+    parser.add_argument("--nodes", type=int, default=3, help="count of common nodes of each shard")
+    parser.add_argument("--shards", type=int, default=1, help="count of shards")
+    parser.add_argument("--requests", type=int, default=1000, help="requests of each phase")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at the same time")
+    parser.add_argument("--batch", type=int, default=50, help="records per request of batch phase, 0 to skip")
+    parser.add_argument("--no-failover", action="store_true", help="skip failover and sync phases")
+    parser.add_argument("--slow-delay", type=float, default=0, help="ms followers are slowed down by, 0 to skip")
+    parser.add_argument("--kill-followers", type=int, default=0, help="followers killed while writing, 0 to skip")
+    parser.add_argument("--config", default="{}", help="json of config overrides for all nodes")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    prefix = uuid.uuid4().hex[:8]
+    results = []
+    with Cluster(args.nodes, json.loads(args.config), proxy=bool(args.slow_delay), shards=args.shards) as cluster:
+        nodes = cluster.alive_nodes()
+        results.append(drive("write", nodes, args.requests, args.concurrency, put_one(prefix)))
+        if args.batch:
+            results.append(drive("write_batch", nodes, max(1, args.requests // args.batch), args.concurrency,
+                                 put_batch(prefix + "b", args.batch), args.batch))
+        results.append(measure_phases(cluster.wait_leader()))
+        results.append(drive("read_page", nodes, args.requests, args.concurrency, get_page))
+        results.append(drive("read_one", nodes, args.requests, args.concurrency, get_one(prefix, args.requests)))
+        if args.slow_delay:
+            results.append(measure_degraded(cluster, "write_slow", cluster.followers()[:1], args.requests,
+                                            args.concurrency, prefix + "s", args.slow_delay / 1000))
+            results.append(measure_converge(cluster))
+        if args.kill_followers:
+            results.append(measure_degraded(cluster, "write_killed", cluster.followers()[:args.kill_followers],
+                                            args.requests, args.concurrency, prefix + "k"))
+            results.append(measure_converge(cluster))
+        if not args.no_failover and args.nodes > 1:
+            failover = measure_failover(cluster, prefix + "f")
+            results.append(failover)
+            results.append(measure_sync(cluster, failover["killed"]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
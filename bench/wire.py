@@ -0,0 +1,74 @@
+"""
+Micro benchmark of wire formats of rpc, run from root of repo:
+
+    python -m bench.wire --records 1 100 1000
+
+For a prepare request of given count of records, it reports time to encode and decode it, and its size,
+in json and msgpack, and in both compressed as snapshot chunks are.
+"""
+import argparse
+import json
+import timeit
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# same as utils.pack and utils.unpack, which can't be imported without a config.py
+def pack(data) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack(body: bytes):
+    return msgpack.unpackb(body, raw=False)
+
+
+def prepare_request(records) -> dict:
+    return {"txn_id": "0" * 32, "data": [{"data_id": str(100000 + i), "raw": "x" * 64, "signature": "s" * 32,
+                                          "seq": 100000 + i} for i in range(records)]}
+
+
+FORMATS = {
+    "json": (lambda data: json.dumps(data, separators=(",", ":")).encode(), json.loads),
+    "msgpack": (pack, unpack),
+    "json+zlib": (lambda data: zlib.compress(json.dumps(data, separators=(",", ":")).encode()),
+                  lambda body: json.loads(zlib.decompress(body))),
+    "msgpack+zlib": (lambda data: zlib.compress(pack(data)), lambda body: unpack(zlib.decompress(body))),
+}
+
+
+def measure(name, records, repeat) -> dict:
+    encode, decode = FORMATS[name]
+    data = prepare_request(records)
+    body = encode(data)
+    assert decode(body) == data
+    encode_us = min(timeit.repeat(lambda: encode(data), number=repeat, repeat=3)) / repeat * 1e6
+    decode_us = min(timeit.repeat(lambda: decode(body), number=repeat, repeat=3)) / repeat * 1e6
+    return {"format": name, "records": records, "bytes": len(body), "encode_us": encode_us, "decode_us": decode_us}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare wire formats of rpc.")
+    parser.add_argument("--records", type=int, nargs="+", default=[1, 100, 1000], help="records per request")
+    parser.add_argument("--repeat", type=int, default=200, help="encodes and decodes timed of each case")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    formats = [name for name in FORMATS if msgpack is not None or "msgpack" not in name]
+    if msgpack is None:
+        print("msgpack is not installed, only json is measured")
+    results = [measure(name, records, args.repeat) for records in args.records for name in formats]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print("{format:<13} records={records:<6} bytes={bytes:<8} encode={encode_us:10.1f}us "
+              "decode={decode_us:10.1f}us".format(**r))
+
+
+if __name__ == '__main__':
+    main()
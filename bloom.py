@@ -0,0 +1,44 @@
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """
+    Bloom filter over strings, tells a key is "maybe added" or "definitely not added".
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param capacity: count of keys it's sized for, error rate grows when more keys are added
+        :param error_rate: expected false positive rate when it's full
+        """
+        self.capacity = capacity
+        self.count = 0
+        self._size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._hashes = max(1, int(round(self._size / capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for p in positions:
+                self._bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    @property
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
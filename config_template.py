@@ -1,6 +1,126 @@
 CENTRAL_NODE_ADDRESS = "a.com:5000"
 NODE_CHECK_INTERVAL = 5
 
+# common node sends heartbeat to central node every HEARTBEAT_INTERVAL seconds,
+#   and central node removes a node if it has no heartbeat in NODE_TTL seconds.
+# if it's disabled, central node pings all nodes every NODE_CHECK_INTERVAL seconds instead.
+HEARTBEAT_ENABLED = True
+HEARTBEAT_INTERVAL = 1
+NODE_TTL = 3
+
+# leader holds a lease in central node and renews it every LEADER_LEASE_RENEW_INTERVAL seconds,
+#   it stops accepting proposals once its lease is not renewed in LEADER_LEASE_TTL seconds.
+#   other nodes read the lease every LEADER_LEASE_CHECK_INTERVAL seconds, when it's expired,
+#   the next node in order of election acquires it at once, and each node after waits LEADER_LEASE_BACKOFF more.
+# if it's disabled, leader is voted by nodes and checked by ping every NODE_CHECK_INTERVAL seconds instead.
+LEADER_LEASE_ENABLED = True
+LEADER_LEASE_TTL = 0.6
+LEADER_LEASE_RENEW_INTERVAL = 0.15
+LEADER_LEASE_CHECK_INTERVAL = 0.1
+LEADER_LEASE_BACKOFF = 0.3
+
+# connect and read deadline for a single rpc to a peer, in seconds
+RPC_CONNECT_TIMEOUT = 1
+RPC_TIMEOUT = 3
+# read deadline of rpc that wait for a whole proposal or transfer all data, in seconds
+PROPOSAL_TIMEOUT = 20
+SYNC_TIMEOUT = 60
+# retries with backoff of rpc, only connect errors and idempotent calls are retried
+RPC_RETRIES = 2
+RPC_RETRY_BACKOFF = 0.1
+# how many peers to keep connection pool for, and max keep-alive connections per peer
+RPC_POOL_CONNECTIONS = 32
+RPC_POOL_MAXSIZE = 16
+# encoding of rpc bodies between nodes, "msgpack" or "json", falls back to json if msgpack is not installed.
+#   nodes answer in the encoding a client asks for, so clients other than nodes always get json.
+RPC_WIRE_FORMAT = "msgpack"
+
+# max count of data in a page of GET /data/, and count of data read from db at a time when streaming
+DATA_PAGE_MAX_LIMIT = 1000
+DATA_STREAM_CHUNK_SIZE = 1000
+# count of data in a page when a node retrieve data from another node
+SYNC_PAGE_SIZE = 1000
+# count of data cached in memory for lookup by data_id, 0 to disable
+DATA_CACHE_SIZE = 100000
+# every node keeps a merkle tree over its data in ANTI_ENTROPY_BUCKETS buckets by data_id,
+#   common node compares it with leader's every ANTI_ENTROPY_INTERVAL seconds and repairs buckets differ.
+#   ANTI_ENTROPY_BUCKETS must be a power of ANTI_ENTROPY_FANOUT and same on all nodes.
+ANTI_ENTROPY_ENABLED = True
+ANTI_ENTROPY_INTERVAL = 60
+ANTI_ENTROPY_BUCKETS = 4096
+ANTI_ENTROPY_FANOUT = 16
+# count of buckets fetched from leader in one request when repairing
+ANTI_ENTROPY_BATCH = 64
+# a brand-new node bootstraps from a snapshot of leader, streamed in zlib compressed and checksummed chunks,
+#   each chunk has SNAPSHOT_CHUNK_SIZE datas and is applied in one transaction, so bootstrap resumes after it.
+SNAPSHOT_CHUNK_SIZE = 5000
+SNAPSHOT_COMPRESS_LEVEL = 6
+SNAPSHOT_READ_BUFFER = 256 * 1024
+
+# leader commits proposals in rounds, a round starts when it has GROUP_COMMIT_MAX_SIZE datas,
+#   or its oldest data has waited GROUP_COMMIT_LINGER seconds
+GROUP_COMMIT_MAX_SIZE = 500
+GROUP_COMMIT_LINGER = 0.005
+# rounds in flight at the same time, rounds prepare concurrently and submit in order of seq
+GROUP_COMMIT_WORKERS = 4
+
+# replicate through an append-only log on every node instead of prepare_data table,
+#   data table is applied from log asynchronously, and log is used by restarting nodes to catch up.
+REPLICATION_LOG_ENABLED = False
+REPLICATION_LOG_PATH = "./replication_log"
+REPLICATION_LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+# latest segments kept even if they are applied, for other nodes to catch up
+REPLICATION_LOG_RETAIN_SEGMENTS = 4
+# seconds a prepared entry waits for its commit or abort before it's dropped by applier
+REPLICATION_LOG_PREPARE_EXPIRE = 60
+
+# leader keeps a bloom filter of committed data_ids in memory, db is queried only when it may be a dup
+DUP_INDEX_ENABLED = True
+# count of data_ids it's sized for at least, it's rebuilt with double size when it's full
+DUP_INDEX_CAPACITY = 1000000
+DUP_INDEX_ERROR_RATE = 0.001
+
+# how long a common node trusts its cached node list before revalidating with central node, in seconds
+MEMBERSHIP_CACHE_TTL = 1
+# common node watches central node for changes of node list instead, a watch is answered as soon as node list
+#   is changed or after MEMBERSHIP_WATCH_TIMEOUT seconds, central node keeps last MEMBERSHIP_CHANGES_KEPT changes
+# a watch holds a handler thread of central node, central node holds at most MEMBERSHIP_WATCH_MAX watches and
+#   answers the rest right away, those nodes poll every MEMBERSHIP_CACHE_TTL seconds until a watch is held,
+#   keep it well below SERVER_THREADS so heartbeats and leases are served
+MEMBERSHIP_WATCH_ENABLED = True
+MEMBERSHIP_WATCH_TIMEOUT = 30
+MEMBERSHIP_CHANGES_KEPT = 1000
+MEMBERSHIP_WATCH_MAX = 32
+# "all" commits a transaction when all nodes prepared and submitted it, "majority" as soon as a majority of nodes
+#   including leader did, nodes left behind catch up from leader when their high-water mark stops rising
+#   for CATCH_UP_INTERVAL seconds, and a node becoming leader catches up from a majority first
+COMMIT_POLICY = "all"
+CATCH_UP_INTERVAL = 1
+# in "majority" policy, a node with so many rpc of leader still in flight is not sent more until they finish
+QUORUM_MAX_INFLIGHT = 8
+# key space is split into shards by consistent hashing of data_id, each shard is a cluster of its own nodes
+#   with its own leader, and a node forwards a write to leader of the shard owns it.
+#   SHARD_IDS must be the same on all nodes including central node, SHARD_ID is the shard this node serves.
+#   Data is not moved when SHARD_IDS is changed, so shards are planned before any data is written.
+SHARD_ID = 0
+SHARD_IDS = [0]
+# points of each shard on hash ring, more of them split data more evenly
+SHARD_VNODES = 64
+# max threads forwarding batches to leaders of shards concurrently, apart from FAN_OUT_WORKERS used by 2PC
+SHARD_FORWARD_WORKERS = 32
+# deadline for a whole phase that sent to all peers concurrently, in seconds
+PREPARE_TIMEOUT = 5
+SUBMIT_TIMEOUT = 5
+ROLLBACK_TIMEOUT = 5
+# leader submits rounds in order of seq, a round waits at most SEQUENCER_TURN_TIMEOUT seconds for rounds before it,
+#   then all waiting rounds are rolled back and seq are handed out again from last seq used
+SEQUENCER_TURN_TIMEOUT = 30
+# deadline of a ping to a node, and of a sweep that checks all nodes concurrently, in seconds
+PING_TIMEOUT = 1
+HEALTH_CHECK_TIMEOUT = 2
+# max threads used to send rpc to peers concurrently
+FAN_OUT_WORKERS = 32
+
 
 IS_CENTRAL_NODE = True
 
@@ -9,10 +129,35 @@ NODE_PORT = 5000
 
 NODE_ADDRESS = "a.com:{}".format(NODE_PORT)
 
+# "waitress" to run a production server, or "dev" to run flask's development server
+SERVER_MODE = "waitress"
+# threads running handlers, a proposal holds one until it's committed
+SERVER_THREADS = 64
+# max client connections accepted at the same time, and backlog of listening socket
+SERVER_CONNECTION_LIMIT = 4096
+SERVER_BACKLOG = 2048
+# seconds an idle client connection is kept
+SERVER_CHANNEL_TIMEOUT = 120
+
+# set "fake" to True to use an in process stand-in instead of a redis server
+REDIS_CONFIG = {
+    "host": "localhost",
+    "port": 6379,
+    "db": 10,
+    "fake": False,
+}
+
+# "engine" is "mysql", or "sqlite" to use an embedded db file at "db_name" instead,
+#   sqlite pragmas can be overridden by "pragmas", e.g. {"synchronous": "full"}
+# "pool" keeps up to "max_connections" connections for reuse, a handler checks one out at its first query and returns
+#   it when finished, a connection older than "stale_timeout" seconds is closed instead of reused,
+#   and a handler waits for a free one up to "timeout" seconds, remove "pool" to open a connection per thread
 db_config = {
+    "engine": "mysql",
     "db_name": "xxx",
     "db_user": "xxx",
     "db_password": "xxx",
     "db_host": "localhost",
     "db_port": 3306,
+    "pool": {"max_connections": 32, "stale_timeout": 300, "timeout": 10},
 }
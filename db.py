@@ -1,19 +1,159 @@
+import threading
+import time
+from contextlib import contextmanager
+
 from peewee import *
-from config import db_config
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+from bloom import BloomFilter
+from lru import LRUCache
+from merkle import MerkleTree, bucket_of, row_hash
+from metrics import timed, observe
+from config import (db_config, DUP_INDEX_ENABLED, DUP_INDEX_CAPACITY, DUP_INDEX_ERROR_RATE, DATA_CACHE_SIZE,
+                    ANTI_ENTROPY_BUCKETS, ANTI_ENTROPY_FANOUT)
+
+
+class _PoolWaitMixin:
+    """
+    Observe how long a connection is waited for when it's checked out from pool, including connecting a new one.
+    """
+
+    def connect(self, reuse_if_open=False):
+        start = time.perf_counter()
+        opened = super().connect(reuse_if_open)
+        if opened:
+            observe("dbs_db_pool_wait_seconds", time.perf_counter() - start)
+        return opened
+
+
+class _PooledMySQLDatabase(_PoolWaitMixin, PooledMySQLDatabase):
+    pass
+
+
+class _PooledSqliteDatabase(_PoolWaitMixin, PooledSqliteDatabase):
+    pass
+
+
+def _make_mysql(config) -> Database:
+    kwargs = dict(user=config["db_user"], password=config["db_password"], host=config["db_host"],
+                  port=config["db_port"])
+    if "pool" in config:
+        return _PooledMySQLDatabase(config["db_name"], **config["pool"], **kwargs)
+    return MySQLDatabase(config["db_name"], **kwargs)
+
+
+def _make_sqlite(config) -> Database:
+    """
+    Embedded db in a file at "db_name", tuned for bulk writes.
+    WAL with synchronous=normal is durable across process crash, but may lose last commits on power loss.
+    """
+    pragmas = dict({
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+    }, **config.get("pragmas", {}))
+    if "pool" in config:
+        # "timeout" of pool is how long to wait for a free connection, wait for a lock by pragma instead
+        pragmas.setdefault("busy_timeout", int(config.get("timeout", 10) * 1000))
+        return _PooledSqliteDatabase(config["db_name"], pragmas=pragmas, check_same_thread=False, **config["pool"])
+    return SqliteDatabase(config["db_name"], pragmas=pragmas, timeout=config.get("timeout", 10))
+
+
+# storage engines selectable by "engine" in db_config, all storage functions below work with any of them
+ENGINES = {
+    "mysql": _make_mysql,
+    "sqlite": _make_sqlite,
+}
+
+# rows per insert statement, keeps statements under sqlite's limit of variables
+BULK_INSERT_ROWS = 100
+
+database = DatabaseProxy()
+database.initialize(ENGINES[db_config.get("engine", "mysql")](db_config))
+
+
+@contextmanager
+def connection_context():
+    """
+    Hold a connection for this thread while in context, it's checked out from pool if pool is configured,
+        and closed or returned to pool when leave. A connection already opened by this thread is used as is.
+    """
+    opened = database.connect(reuse_if_open=True)
+    try:
+        yield
+    finally:
+        if opened:
+            database.close()
+
+
+def close_connection():
+    """
+    Close connection of this thread if it's opened, or return it to pool if pool is configured.
+    """
+    if not database.is_closed():
+        database.close()
 
-mysql_db = MySQLDatabase(db_config["db_name"], user=db_config["db_user"], password=db_config["db_password"],
-                         host=db_config["db_host"], port=db_config["db_port"])
+
+def get_db_pool_stats() -> dict:
+    """
+    Get stats of connection pool.
+    :return: e.g. {"in_use": 1, "idle": 2, "max": 32}, empty if pool is not configured.
+    """
+    db = database.obj
+    if not isinstance(db, _PoolWaitMixin):
+        return {}
+    return {"in_use": len(db._in_use), "idle": len(db._connections), "max": db._max_connections}
+
+
+class _Param:
+    """
+    Placeholder of a parameter of a prepared statement, tells its position in parameters given.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+
+# sql of hot queries, built and compiled by peewee only once, e.g. {"dup:2": ("SELECT ...", [0, 1])}
+_statements = {}
+
+
+def _execute_prepared(key, build, params, many=False):
+    """
+    Execute a hot query with parameters, by its sql compiled the first time.
+    :param key: name of query, queries of a name must have same sql
+    :param build: function returns the query, given placeholders of its parameters in order
+    :param params: parameters of query, e.g. ["1", 2], or a list of them if many is True
+    :param many: execute query once with each of parameters, in a batch
+    :return: cursor
+    """
+    statement = _statements.get(key)
+    if statement is None:
+        count = len(params[0] if many else params)
+        sql, placeholders = build(*[Value(_Param(i), converter=False) for i in range(count)]).sql()
+        statement = _statements[key] = (sql, [i.index for i in placeholders])
+    sql, order = statement
+    if many:
+        cursor = database.cursor()
+        cursor.executemany(sql, [[i[j] for j in order] for i in params])
+        return cursor
+    return database.execute_sql(sql, [params[j] for j in order])
 
 
 class BaseModel(Model):
     class Meta:
-        database = mysql_db
+        database = database
 
 
 class PrepareData(BaseModel):
     data_id = CharField(index=True, unique=True)
     raw = CharField()
     signature = CharField()
+    seq = BigIntegerField(null=True)
+    # transaction that prepared this data, prepare data are submitted or rolled back by transaction
+    txn_id = CharField(index=True, default="")
+    bucket = IntegerField(null=True)
 
     class Meta:
         table_name = "prepare_data"
@@ -26,6 +166,10 @@ class Data(BaseModel):
     data_id = CharField(index=True, unique=True)
     raw = CharField()
     signature = CharField()
+    # commit sequence assigned by leader, increases monotonically with every committed data
+    seq = BigIntegerField(index=True, null=True)
+    # bucket of data_id in merkle tree, see merkle.bucket_of
+    bucket = IntegerField(index=True, null=True)
 
     class Meta:
         table_name = "data"
@@ -34,12 +178,186 @@ class Data(BaseModel):
         return self.data_id
 
 
+class SyncState(BaseModel):
+    name = CharField(primary_key=True)
+    value = BigIntegerField()
+
+    class Meta:
+        table_name = "sync_state"
+
+
+class SnapshotProgress(BaseModel):
+    """
+    Progress of a snapshot being received by this node, kept until the snapshot is complete.
+    """
+    name = CharField(primary_key=True)
+    # snapshot contains data with seq not greater than it
+    seq = BigIntegerField()
+    # data_id of last data applied, chunks are ordered by data_id
+    cursor = CharField()
+    chunks = IntegerField(default=0)
+
+    class Meta:
+        table_name = "snapshot_progress"
+
+
+# only one snapshot is received at a time
+BOOTSTRAP = "bootstrap"
+# all data with seq not greater than it are existed in this node
+APPLIED_SEQ = "applied_seq"
+# all entries of replication log not greater than it are applied to data
+LOG_APPLIED_INDEX = "log_applied_index"
+
+
+# in memory index of committed data_ids, built when it's first used and updated when data committed.
+#   A new index is loaded in background and published only when it's complete, data committed meanwhile are added
+#   to both, until then dup check is answered by the old index if it's only too full, or by db.
+_dup_index = None
+_dup_index_loading = None
+_dup_index_building = False
+_dup_index_lock = threading.Lock()
+
+
+def _get_dup_index() -> BloomFilter:
+    """
+    Get dup index, start building it from db in background if it's not built or too full to be accurate.
+    :return: dup index, None if it's not built yet
+    """
+    global _dup_index_building
+    index = _dup_index
+    if index is None or index.full:
+        with _dup_index_lock:
+            if not _dup_index_building:
+                _dup_index_building = True
+                threading.Thread(target=_build_dup_index, args=(index,), daemon=True).start()
+    return index
+
+
+def _build_dup_index(old):
+    """
+    Build a new dup index from db, at double capacity of old one if it's given, and publish it when it's complete.
+    """
+    global _dup_index, _dup_index_loading, _dup_index_building
+    try:
+        with connection_context():
+            count = Data.select().count()
+            capacity = max(DUP_INDEX_CAPACITY, count * 2, old.capacity * 2 if old else 0)
+            index = BloomFilter(capacity, DUP_INDEX_ERROR_RATE)
+            # data committed while loading are added to it as well
+            _dup_index_loading = index
+            for i in Data.select(Data.data_id).tuples().iterator():
+                index.add(i[0])
+        _dup_index = index
+        print("dup index built: {} data_ids, capacity {}, {} bytes".format(index.count, index.capacity,
+                                                                          index.size_bytes))
+    except Exception as e:
+        print("build dup index failed: {}".format(e))
+    finally:
+        _dup_index_loading = None
+        _dup_index_building = False
+
+
+def _add_to_dup_index(data_ids):
+    # loading one is read first, it's published as _dup_index before it's cleared
+    loading = _dup_index_loading
+    index = _dup_index
+    for target in (index, loading if loading is not index else None):
+        if target is not None:
+            for i in data_ids:
+                target.add(i)
+
+
+def get_dup_index_stats() -> dict:
+    """
+    Get stats of dup index.
+    :return: e.g. {"data_ids": 1, "capacity": 100000, "bytes": 179720}, empty if it's not built.
+    """
+    index = _dup_index
+    if index is None:
+        return {}
+    return {"data_ids": index.count, "capacity": index.capacity, "bytes": index.size_bytes}
+
+
+# cache of data looked up by data_id, a data_id not existed is cached as None.
+#   committed data_ids are invalidated, so a data_id cached as not existed is looked up again.
+_data_cache = LRUCache(DATA_CACHE_SIZE) if DATA_CACHE_SIZE else None
+_NOT_CACHED = object()
+
+
+def _with_bucket(data: [dict]) -> [dict]:
+    return [dict(i, bucket=bucket_of(i["data_id"], ANTI_ENTROPY_BUCKETS)) for i in data]
+
+
+def _load_bucket_digests(buckets=None) -> dict:
+    """
+    Compute digest of given buckets from db, data without bucket (inserted by an older version) are given one first.
+    :param buckets: buckets to compute, None for all buckets
+    :return: dict of bucket and its digest, e.g. {0: 123}
+    """
+    _fill_buckets()
+    digests = dict.fromkeys(range(ANTI_ENTROPY_BUCKETS) if buckets is None else buckets, 0)
+    query = Data.select(Data.bucket, Data.data_id, Data.raw, Data.signature)
+    groups = [None] if buckets is None else chunked(buckets, BULK_INSERT_ROWS)
+    for group in groups:
+        q = query if group is None else query.where(Data.bucket.in_(group))
+        for bucket, data_id, raw, signature in q.tuples().iterator():
+            digests[bucket] ^= row_hash(data_id, raw, signature)
+    return digests
+
+
+def _fill_buckets():
+    while True:
+        data_ids = [i[0] for i in Data.select(Data.data_id).where(Data.bucket.is_null()).limit(1000).tuples()]
+        if not data_ids:
+            return
+        by_bucket = {}
+        for i in data_ids:
+            by_bucket.setdefault(bucket_of(i, ANTI_ENTROPY_BUCKETS), []).append(i)
+        with database.atomic():
+            for bucket, ids in by_bucket.items():
+                Data.update(bucket=bucket).where(Data.data_id.in_(ids)).execute()
+
+
+# hash tree over data of this node, compared with leader's to find data diverged
+merkle_tree = MerkleTree(ANTI_ENTROPY_BUCKETS, ANTI_ENTROPY_FANOUT, _load_bucket_digests)
+
+
+def _on_committed(data_ids):
+    """
+    Update dup index, data cache and merkle tree with data_ids just committed.
+    """
+    _add_to_dup_index(data_ids)
+    if _data_cache is not None:
+        _data_cache.invalidate(data_ids)
+    merkle_tree.invalidate({bucket_of(i, ANTI_ENTROPY_BUCKETS) for i in data_ids})
+
+
+def get_data_cache_stats() -> dict:
+    """
+    Get stats of data cache.
+    :return: e.g. {"size": 1, "capacity": 10000, "hits": 2, "misses": 1}, empty if it's disabled.
+    """
+    if _data_cache is None:
+        return {}
+    return {"size": len(_data_cache), "capacity": _data_cache.capacity, "hits": _data_cache.hits,
+            "misses": _data_cache.misses}
+
+
+def init_db():
+    """
+    Create tables if not existed.
+    """
+    database.create_tables([PrepareData, Data, SyncState, SnapshotProgress], safe=True)
+    for name in (APPLIED_SEQ, LOG_APPLIED_INDEX):
+        SyncState.insert(name=name, value=0).on_conflict_ignore().execute()
+
+
 def get_all_prepare() -> [dict]:
     """
     Get all prepare data from db.
     :return: result of query, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
     """
-    return [{"data_id": i.data_id, "raw": i.raw, "signature": i.signature} for i in PrepareData.select()]
+    return [{"data_id": i.data_id, "raw": i.raw, "signature": i.signature, "seq": i.seq} for i in PrepareData.select()]
 
 
 def get_all_data_from_db() -> [dict]:
@@ -50,58 +368,370 @@ def get_all_data_from_db() -> [dict]:
     return [{"data_id": i.data_id, "raw": i.raw, "signature": i.signature} for i in Data.select()]
 
 
-def insert_data_to_prepare(data: [dict]) -> bool:
+@timed("dbs_db_seconds", op="get_data_page")
+def get_data_page(after=None, limit=100) -> [dict]:
+    """
+    Get a page of data ordered by data_id, using keyset on data_id so it's cheap wherever the page is.
+    :param after: data_id of last data in previous page, None for first page
+    :param limit: max count of data in this page
+    :return: result of query, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    """
+    query = Data.select(Data.data_id, Data.raw, Data.signature, Data.seq).order_by(Data.data_id).limit(limit)
+    if after is not None:
+        query = query.where(Data.data_id > after)
+    return list(query.dicts().iterator())
+
+
+def get_data_by_ids(data_ids: [str]) -> dict:
+    """
+    Get data by data_id, from data cache if they're cached, or from db in one query on unique index of data_id.
+    :param data_ids: data_ids to get, e.g. ["1", "2"]
+    :return: dict of data_id and data, None if it's not existed,
+        e.g. {"1": {"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}, "2": None}
+    """
+    if _data_cache is None:
+        return _query_data_by_ids(data_ids)
+    result = {}
+    missed = []
+    for i in data_ids:
+        data = _data_cache.get(i, _NOT_CACHED)
+        if data is _NOT_CACHED:
+            missed.append(i)
+        else:
+            result[i] = data
+    if missed:
+        result.update(_query_data_by_ids(missed))
+    return result
+
+
+@timed("dbs_db_seconds", op="get_data_by_ids")
+def _query_data_by_ids(data_ids: [str]) -> dict:
+    generation = _data_cache.generation if _data_cache is not None else None
+    query = (Data.select(Data.data_id, Data.raw, Data.signature, Data.seq)
+             .where(Data.data_id.in_(list(set(data_ids)))))
+    result = dict.fromkeys(data_ids)
+    for data in query.dicts().iterator():
+        result[data["data_id"]] = data
+    if _data_cache is not None:
+        for data_id, data in result.items():
+            _data_cache.put(data_id, data, generation)
+    return result
+
+
+@timed("dbs_db_seconds", op="get_data_since")
+def get_data_since(seq, limit=100) -> [dict]:
+    """
+    Get a page of data committed after given seq, ordered by seq.
+    :param seq: only data with greater seq are returned
+    :param limit: max count of data in this page
+    :return: result of query, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    """
+    query = (Data.select(Data.data_id, Data.raw, Data.signature, Data.seq)
+             .where(Data.seq > seq).order_by(Data.seq).limit(limit))
+    return list(query.dicts().iterator())
+
+
+def get_max_seq() -> int:
+    """
+    Get max commit seq in db.
+    :return: max seq, 0 if no data has seq
+    """
+    return Data.select(fn.MAX(Data.seq)).scalar() or 0
+
+
+def get_applied_seq() -> int:
+    """
+    Get high-water mark of this node, all data with seq not greater than it are existed.
+    :return: applied seq
+    """
+    return SyncState.get_by_id(APPLIED_SEQ).value
+
+
+def set_applied_seq(seq) -> bool:
+    """
+    Raise high-water mark of this node to given seq, will not lower it.
+    :return: result of query
+    """
+    SyncState.update(value=seq).where((SyncState.name == APPLIED_SEQ) & (SyncState.value < seq)).execute()
+    return True
+
+
+@timed("dbs_db_seconds", op="get_snapshot_page")
+def get_snapshot_page(seq, after=None, limit=100) -> [dict]:
+    """
+    Get a page of snapshot at given seq, that's data with seq not greater than it or without seq, ordered by data_id.
+    Data committed later are not in any page, so pages read at different time are of the same snapshot.
+    :param seq: seq of snapshot
+    :param after: data_id of last data in previous page, None for first page
+    :param limit: max count of data in this page
+    :return: result of query, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    """
+    query = (Data.select(Data.data_id, Data.raw, Data.signature, Data.seq)
+             .where((Data.seq <= seq) | Data.seq.is_null()).order_by(Data.data_id).limit(limit))
+    if after is not None:
+        query = query.where(Data.data_id > after)
+    return list(query.dicts().iterator())
+
+
+def get_snapshot_progress() -> (int, str):
+    """
+    Get progress of snapshot being received.
+    :return: seq of snapshot and data_id of last data applied, (None, None) if no snapshot is being received.
+    """
+    progress = SnapshotProgress.get_or_none(SnapshotProgress.name == BOOTSTRAP)
+    if progress is None:
+        return None, None
+    return progress.seq, progress.cursor
+
+
+@timed("dbs_db_seconds", op="apply_snapshot_chunk")
+def apply_snapshot_chunk(data: [dict], seq, cursor) -> bool:
+    """
+    Insert a chunk of snapshot to data and save progress in one transaction, so receiving resumes after it.
+    :param data: datas, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    :param seq: seq of snapshot
+    :param cursor: data_id of last data in chunk
+    :return: result of query
+    """
+    with database.atomic():
+        for rows in chunked(_with_bucket(data), BULK_INSERT_ROWS):
+            Data.insert_many(rows).on_conflict_replace().execute()
+        updated = (SnapshotProgress.update(cursor=cursor, chunks=SnapshotProgress.chunks + 1)
+                   .where((SnapshotProgress.name == BOOTSTRAP) & (SnapshotProgress.seq == seq)).execute())
+        if not updated:
+            SnapshotProgress.delete().where(SnapshotProgress.name == BOOTSTRAP).execute()
+            SnapshotProgress.create(name=BOOTSTRAP, seq=seq, cursor=cursor, chunks=1)
+    _on_committed([i.get("data_id", "") for i in data])
+    return True
+
+
+def finish_snapshot(seq) -> bool:
+    """
+    Raise high-water mark to seq of received snapshot and forget its progress.
+    :return: result of query
+    """
+    with database.atomic():
+        set_applied_seq(seq)
+        SnapshotProgress.delete().where(SnapshotProgress.name == BOOTSTRAP).execute()
+    return True
+
+
+def clear_snapshot_progress() -> bool:
+    """
+    Forget progress of snapshot being received, next snapshot starts over.
+    :return: result of query
+    """
+    SnapshotProgress.delete().where(SnapshotProgress.name == BOOTSTRAP).execute()
+    return True
+
+
+def iter_all_data_from_db(chunk_size=1000):
+    """
+    Iterate all data in db lazily, only one chunk of data is in memory at a time.
+    :param chunk_size: count of data read from db at a time
+    :return: generator of data, e.g. {"data_id": "1", "raw": "a", "signature": "aaa"}
+    """
+    after = None
+    while True:
+        page = get_data_page(after, chunk_size)
+        yield from page
+        if len(page) < chunk_size:
+            return
+        after = page[-1]["data_id"]
+
+
+@timed("dbs_db_seconds", op="insert_data_to_prepare")
+def insert_data_to_prepare(data: [dict], txn_id="") -> bool:
     """
     Insert data to prepare.
     :param data: datas, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
+    :param txn_id: transaction that these data belong to
     :return: result of query
     """
-    return PrepareData.insert_many(data).execute()
+    fields = ["data_id", "raw", "signature", "seq", "bucket"]
+    rows = [[i.get(f) for f in fields] + [txn_id] for i in _with_bucket(data)]
+    if not rows:
+        return True
+    with database.atomic():
+        _execute_prepared("insert_prepare", lambda *p: PrepareData.insert(
+            dict(zip(fields + ["txn_id"], p))), rows, many=True)
+    return True
 
 
+@timed("dbs_db_seconds", op="insert_data")
 def insert_data(data: [dict]) -> bool:
     """
     Insert data to data, pls be noticed that it will replace if conflict on data_id.
     :param data: datas, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
     :return: result of query
     """
-    return Data.insert_many(data).on_conflict_replace().execute()
+    with database.atomic():
+        for rows in chunked(_with_bucket(data), BULK_INSERT_ROWS):
+            Data.insert_many(rows).on_conflict_replace().execute()
+    _on_committed([i.get("data_id", "") for i in data])
+    return True
+
+
+@timed("dbs_db_seconds", op="apply_data")
+def apply_data(data: [dict], first_seq, last_seq) -> bool:
+    """
+    Insert committed data to data, and raise high-water mark if their seq follow it.
+    :param data: datas, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    :param first_seq: seq of first data
+    :param last_seq: seq of last data
+    :return: result of query
+    """
+    with database.atomic():
+        for rows in chunked(_with_bucket(data), BULK_INSERT_ROWS):
+            Data.insert_many(rows).on_conflict_replace().execute()
+        SyncState.update(value=last_seq).where(
+            (SyncState.name == APPLIED_SEQ) & (SyncState.value == first_seq - 1)).execute()
+    _on_committed([i.get("data_id", "") for i in data])
+    return True
+
+
+def get_log_applied_index() -> int:
+    """
+    Get index of replication log that all entries not greater than it are applied.
+    :return: applied index
+    """
+    return SyncState.get_by_id(LOG_APPLIED_INDEX).value
 
 
-def submit_prepare() -> bool:
+def set_log_applied_index(index) -> bool:
     """
-    Move all prepare data to data.
+    Set index of replication log that all entries not greater than it are applied.
     :return: result of query
     """
-    with mysql_db.atomic() as transaction:
+    SyncState.update(value=index).where(SyncState.name == LOG_APPLIED_INDEX).execute()
+    return True
+
+
+@timed("dbs_db_seconds", op="submit_prepare")
+def submit_prepare(txn_id="", first_seq=None, last_seq=None) -> bool:
+    """
+    Move prepare data of a transaction to data, in db side without loading them.
+    If seq of prepare data are given and they follow high-water mark of this node, high-water mark is raised too,
+        unless some of them are not prepared in this node, e.g. it's left behind by a quorum, then it catches up later.
+    :param txn_id: transaction to submit
+    :param first_seq: seq of first prepare data
+    :param last_seq: seq of last prepare data
+    :return: result of query
+    """
+    data_ids = [i[0] for i in _execute_prepared("select_prepare", lambda t: PrepareData.select(
+        PrepareData.data_id).where(PrepareData.txn_id == t), [txn_id])]
+    with database.atomic() as transaction:
         try:
-            Data.insert_many(get_all_prepare()).execute()
-            PrepareData.delete().execute()
-            return True
+            fields = [PrepareData.data_id, PrepareData.raw, PrepareData.signature, PrepareData.seq, PrepareData.bucket]
+            # data may be retrieved by catch up already
+            _execute_prepared("submit_prepare", lambda t: Data.insert_from(
+                PrepareData.select(*fields).where(PrepareData.txn_id == t),
+                [Data.data_id, Data.raw, Data.signature, Data.seq, Data.bucket]).on_conflict_replace(), [txn_id])
+            _execute_prepared("delete_prepare", lambda t: PrepareData.delete().where(PrepareData.txn_id == t),
+                              [txn_id])
+            if last_seq is not None and len(data_ids) == last_seq - first_seq + 1:
+                _execute_prepared("raise_applied_seq", lambda v, n, p: SyncState.update(value=v).where(
+                    (SyncState.name == n) & (SyncState.value == p)), [last_seq, APPLIED_SEQ, first_seq - 1])
         except Exception as e:
             print(e)
             transaction.rollback()
             return False
+    _on_committed(data_ids)
+    return True
 
 
-def del_prepare(data: dict) -> bool:
+@timed("dbs_db_seconds", op="del_prepare")
+def del_prepare(txn_id, first_seq=None, last_seq=None) -> bool:
     """
-    Del specific prepare data.
+    Del prepare data of a transaction.
+    If seq of the transaction are given and they follow high-water mark of this node, high-water mark skips them.
+    :param txn_id: transaction to roll back
+    :param first_seq: first seq assigned to the transaction
+    :param last_seq: last seq assigned to the transaction
     :return: result of query
     """
     try:
-        PrepareData.delete().where(PrepareData.data_id == data.get("data_id", "")).execute()
+        with database.atomic():
+            PrepareData.delete().where(PrepareData.txn_id == txn_id).execute()
+            if last_seq is not None:
+                SyncState.update(value=last_seq).where(
+                    (SyncState.name == APPLIED_SEQ) & (SyncState.value == first_seq - 1)).execute()
         return True
     except Exception as e:
         print(e)
         return False
 
 
+def del_settled_prepare(seq) -> int:
+    """
+    Del prepare data with seq not greater than given high-water mark, they are committed or rolled back already,
+        left by transactions this node missed submit or rollback of.
+    :return: count of prepare data deleted
+    """
+    return PrepareData.delete().where(PrepareData.seq <= seq).execute()
+
+
+def get_data_in_buckets(buckets: [int]) -> [dict]:
+    """
+    Get all data in given buckets of merkle tree.
+    :param buckets: buckets, e.g. [0, 1]
+    :return: result of query, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    """
+    query = Data.select(Data.data_id, Data.raw, Data.signature, Data.seq)
+    return [i for group in chunked(buckets, BULK_INSERT_ROWS)
+            for i in query.where(Data.bucket.in_(group)).dicts().iterator()]
+
+
+@timed("dbs_db_seconds", op="repair_buckets")
+def repair_buckets(buckets: [int], data: [dict], seq) -> (int, int):
+    """
+    Make data in given buckets of merkle tree same as data of another node in them.
+    Only data settled on both nodes are repaired, that's data with seq not greater than high-water mark of both,
+        others may be committed at this moment and will arrive in their way.
+    :param buckets: buckets to repair
+    :param data: all data of other node in these buckets,
+        e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    :param seq: high-water mark of other node, read before its data
+    :return: count of data inserted or replaced, and count of data deleted
+    """
+    settled = min(seq, get_applied_seq())
+    local = {i["data_id"]: i for i in get_data_in_buckets(buckets)}
+    remote = {i["data_id"]: i for i in data}
+    upserts = [i for data_id, i in remote.items()
+               if (i["seq"] is None or i["seq"] <= settled) and local.get(data_id) != i]
+    deletes = [data_id for data_id, i in local.items()
+               if data_id not in remote and (i["seq"] is None or i["seq"] <= settled)]
+    with database.atomic():
+        for rows in chunked(_with_bucket(upserts), BULK_INSERT_ROWS):
+            Data.insert_many(rows).on_conflict_replace().execute()
+        for ids in chunked(deletes, BULK_INSERT_ROWS):
+            Data.delete().where(Data.data_id.in_(ids)).execute()
+    _on_committed([i["data_id"] for i in upserts] + deletes)
+    return len(upserts), len(deletes)
+
+
 def check_data_id_dup(data: dict) -> bool:
     """
     Check a data_id of data if is existed in db.
-    :return: result of query
+    :return: result of query, False if it's existed
+    """
+    return not get_existing_data_ids([data.get("data_id", "")])
+
+
+@timed("dbs_db_seconds", op="get_existing_data_ids")
+def get_existing_data_ids(data_ids: [str]) -> set:
+    """
+    Get data_ids which are already existed in db.
+    Only data_ids that may be existed according to dup index are queried in db, in one query.
+    :param data_ids: data_ids to check, e.g. ["1", "2"]
+    :return: set of existed data_ids
     """
-    rows = Data.select(Data.data_id).where(Data.data_id == data.get("data_id", ""))
-    print(len(rows))
-    return False if rows else True
+    index = _get_dup_index() if DUP_INDEX_ENABLED else None
+    if index is not None:
+        data_ids = [i for i in data_ids if i in index]
+    existed = set()
+    for group in chunked(data_ids, BULK_INSERT_ROWS):
+        cursor = _execute_prepared("dup:{}".format(len(group)), lambda *p: Data.select(Data.data_id).where(
+            Data.data_id.in_(list(p))), group)
+        existed.update(i[0] for i in cursor)
+    return existed
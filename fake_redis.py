@@ -0,0 +1,145 @@
+import fnmatch
+import threading
+import time
+
+
+class FakeRedis:
+    """
+    In process stand-in of redis with decoded responses, implements only commands used by redis_utils.
+    Used by tests and benchmark to run a central node without a redis server.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expire_at = {}
+        self._lock = threading.RLock()
+
+    def _alive(self, name) -> bool:
+        expire_at = self._expire_at.get(name)
+        if expire_at is not None and expire_at <= time.time():
+            self._data.pop(name, None)
+            self._expire_at.pop(name, None)
+        return name in self._data
+
+    def get(self, name):
+        with self._lock:
+            return self._data[name] if self._alive(name) else None
+
+    def mget(self, names):
+        with self._lock:
+            return [self.get(name) for name in names]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self._lock:
+            if (nx and self._alive(name)) or (xx and not self._alive(name)):
+                return None
+            self._data[name] = str(value)
+            self._expire_at.pop(name, None)
+            if ex is not None:
+                self._expire_at[name] = time.time() + ex
+            if px is not None:
+                self._expire_at[name] = time.time() + px / 1000
+            return True
+
+    def pttl(self, name):
+        with self._lock:
+            if not self._alive(name):
+                return -2
+            expire_at = self._expire_at.get(name)
+            return -1 if expire_at is None else int((expire_at - time.time()) * 1000)
+
+    def delete(self, *names):
+        with self._lock:
+            count = 0
+            for name in names:
+                if self._alive(name):
+                    del self._data[name]
+                    self._expire_at.pop(name, None)
+                    count += 1
+            return count
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            value = int(self.get(name) or 0) + amount
+            self._data[name] = str(value)
+            return value
+
+    def hget(self, name, key):
+        with self._lock:
+            return self._data[name].get(key) if self._alive(name) else None
+
+    def hset(self, name, key, value):
+        with self._lock:
+            if not self._alive(name):
+                self._data[name] = {}
+            h = self._data[name]
+            created = key not in h
+            h[key] = str(value)
+            return int(created)
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            if not self._alive(name):
+                return 0
+            h = self._data[name]
+            count = sum(1 for key in keys if h.pop(key, None) is not None)
+            if not h:
+                del self._data[name]
+            return count
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._data[name]) if self._alive(name) else {}
+
+    def rpush(self, name, *values):
+        with self._lock:
+            if not self._alive(name):
+                self._data[name] = []
+            self._data[name].extend(str(value) for value in values)
+            return len(self._data[name])
+
+    def ltrim(self, name, start, end):
+        with self._lock:
+            if self._alive(name):
+                self._data[name] = self.lrange(name, start, end)
+                if not self._data[name]:
+                    del self._data[name]
+            return True
+
+    def lrange(self, name, start, end):
+        with self._lock:
+            if not self._alive(name):
+                return []
+            items = self._data[name]
+            # end is inclusive in redis
+            return items[start:] if end == -1 else items[start:end + 1]
+
+    def scan_iter(self, match=None, count=None):
+        with self._lock:
+            names = [name for name in list(self._data) if self._alive(name)]
+        return iter([name for name in names if match is None or fnmatch.fnmatchcase(name, match)])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """
+    Buffer commands and run them together under lock of FakeRedis when executed.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        with self._redis._lock:
+            results = [getattr(self._redis, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return results
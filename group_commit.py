@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class _Pending:
+    def __init__(self, record):
+        self.record = record
+        self.time = time.time()
+        self.result = (False, "not committed")
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Coalesce records proposed concurrently into one commit round.
+    A round starts when max_size records are waiting or the oldest one has waited for linger seconds.
+    Up to workers rounds are committed at the same time, commit must be safe to be called concurrently.
+    """
+
+    def __init__(self, commit, max_size, linger, workers=1):
+        """
+        :param commit: function commit a list of records in one round, returns (bool, msg) per record
+        :param max_size: max records committed in one round
+        :param linger: max seconds a record waits for others to join its round
+        :param workers: max rounds in flight
+        """
+        self._commit = commit
+        self._max_size = max_size
+        self._linger = linger
+        self._workers = workers
+        self._queue = []
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def propose(self, records: [dict]) -> [(bool, str)]:
+        """
+        Add records to next round and wait for it committed.
+        :param records: datas, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa"}]
+        :return: result of each record, bool and msg if failed.
+        """
+        pending = [_Pending(record) for record in records]
+        with self._cond:
+            if not self._threads:
+                self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(self._workers)]
+                for t in self._threads:
+                    t.start()
+            self._queue.extend(pending)
+            self._cond.notify()
+        for p in pending:
+            p.done.wait()
+        return [p.result for p in pending]
+
+    def _next_round(self) -> [_Pending]:
+        with self._cond:
+            while True:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = self._queue[0].time + self._linger
+                while self._queue and len(self._queue) < self._max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                # another worker may have taken the round while waiting
+                if self._queue:
+                    batch = self._queue[:self._max_size]
+                    del self._queue[:self._max_size]
+                    return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_round()
+            try:
+                results = self._commit([p.record for p in batch])
+            except Exception as e:
+                print(e)
+                results = self._commit_alone(batch) if len(batch) > 1 else [(False, "commit failed: {}".format(e))]
+            for p, result in zip(batch, results):
+                p.result = result
+                p.done.set()
+
+    def _commit_alone(self, batch) -> [(bool, str)]:
+        """
+        Commit records of a failed round one by one, so a record making commit raise fails only itself.
+        """
+        results = []
+        for p in batch:
+            try:
+                results.extend(self._commit([p.record]))
+            except Exception as e:
+                print(e)
+                results.append((False, "commit failed: {}".format(e)))
+        return results
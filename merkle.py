@@ -0,0 +1,84 @@
+import hashlib
+import threading
+import zlib
+
+
+def bucket_of(data_id, buckets) -> int:
+    """
+    :return: bucket a data_id belongs to
+    """
+    return zlib.crc32(data_id.encode()) % buckets
+
+
+def row_hash(data_id, raw, signature) -> int:
+    """
+    :return: hash of a data, digest of a bucket is XOR of hash of all data in it, so it doesn't depend on their order
+    """
+    return int.from_bytes(hashlib.blake2b("\0".join((data_id, raw, signature)).encode(), digest_size=16).digest(),
+                          "little")
+
+
+class MerkleTree:
+    """
+    Hash tree over buckets of data, each internal node is hash of its fanout children, leaves are digest of buckets.
+    Level 0 is root, level depth is leaves. Digests of buckets are loaded when tree is first used,
+        and only buckets invalidated since are loaded again when it's used next time.
+    """
+
+    def __init__(self, buckets, fanout, load):
+        """
+        :param buckets: count of buckets, must be a power of fanout
+        :param fanout: count of children of an internal node
+        :param load: function returns digest of given buckets, e.g. {0: 123}, digest of all buckets if None is given
+        """
+        self.buckets = buckets
+        self.fanout = fanout
+        self.depth = 0
+        while fanout ** self.depth < buckets:
+            self.depth += 1
+        if fanout ** self.depth != buckets:
+            raise ValueError("buckets {} is not a power of fanout {}".format(buckets, fanout))
+        self._load = load
+        self._leaves = None
+        self._levels = None
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def invalidate(self, buckets):
+        with self._lock:
+            self._dirty.update(buckets)
+            self._levels = None
+
+    def _refresh(self) -> list:
+        with self._refresh_lock:
+            with self._lock:
+                levels, dirty = self._levels, self._dirty
+                if levels is not None:
+                    return levels
+                self._dirty = set()
+            # buckets invalidated while loading are left dirty, and loaded again next time
+            if self._leaves is None:
+                digests = self._load(None)
+                self._leaves = [digests.get(i, 0) for i in range(self.buckets)]
+            elif dirty:
+                for i, digest in self._load(sorted(dirty)).items():
+                    self._leaves[i] = digest
+            levels = [[i.to_bytes(16, "little") for i in self._leaves]]
+            while len(levels[0]) > 1:
+                below = levels[0]
+                levels.insert(0, [hashlib.blake2b(b"".join(below[i:i + self.fanout]), digest_size=16).digest()
+                                  for i in range(0, len(below), self.fanout)])
+            with self._lock:
+                if not self._dirty:
+                    self._levels = levels
+            return levels
+
+    def root(self) -> str:
+        return self._refresh()[0][0].hex()
+
+    def children(self, level, index) -> [str]:
+        """
+        :return: digest of children of a node, e.g. children(0, 0) are digests of level 1
+        """
+        return [i.hex() for i in self._refresh()[level + 1][index * self.fanout:(index + 1) * self.fanout]]
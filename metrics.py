@@ -0,0 +1,120 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+# (name, labels) -> [count of each bucket..., count of +Inf bucket, sum]
+_histograms = {}
+_gauges = {}
+
+
+def _key(name, labels) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """
+    Increase a counter.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a latency to a histogram.
+    """
+    key = _key(name, labels)
+    i = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        h[i] += 1
+        h[-1] += seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Record time spent in a with block to a histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator records time spent in a function to a histogram.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def gauge(name, func):
+    """
+    Register a gauge, func is called when metrics are rendered,
+        returns a number or dict of labels tuple and number, e.g. {(("node", "aaa"),): 0.1}
+    """
+    _gauges[name] = func
+
+
+def _labels(labels, extra=()) -> str:
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+def render() -> str:
+    """
+    Render all metrics in prometheus text format.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(h) for key, h in _histograms.items()}
+    lines = []
+    typed = set()
+
+    def add_type(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE {} {}".format(name, kind))
+
+    for (name, labels), value in sorted(counters.items()):
+        add_type(name, "counter")
+        lines.append("{}{} {}".format(name, _labels(labels), value))
+    for (name, labels), h in sorted(histograms.items()):
+        add_type(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), h[:-1]):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, [("le", bound)]), cumulative))
+        lines.append("{}_sum{} {}".format(name, _labels(labels), h[-1]))
+        lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+    for name, func in sorted(_gauges.items()):
+        try:
+            value = func()
+        except Exception as e:
+            print("gauge {} failed: {}".format(name, e))
+            continue
+        values = value if isinstance(value, dict) else {(): value}
+        add_type(name, "gauge")
+        for labels, v in sorted(values.items()):
+            lines.append("{}{} {}".format(name, _labels(labels), v))
+    return "\n".join(lines) + "\n"
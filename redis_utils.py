@@ -1,38 +1,222 @@
+import json
+import threading
 import time
 
 import redis
 
-r = redis.StrictRedis(host='localhost', port=6379, db=10, decode_responses=True)
+from config import REDIS_CONFIG, NODE_TTL, MEMBERSHIP_CHANGES_KEPT
+from fake_redis import FakeRedis
 
+if REDIS_CONFIG.get("fake"):
+    r = FakeRedis()
+else:
+    r = redis.StrictRedis(host=REDIS_CONFIG["host"], port=REDIS_CONFIG["port"], db=REDIS_CONFIG["db"],
+                          decode_responses=True)
 
-def add_node(name, address) -> bool:
+# a node is alive as long as its key is not expired, each heartbeat of node refreshes its key
+ALIVE_KEY = "node:alive:{}"
+# name of leader, expires unless leader renews it in time
+LEASE_KEY = "leader:lease"
+# increases every time lease is acquired by a node, tells one leadership from another
+EPOCH_KEY = "leader:epoch"
+# name of last node acquired lease
+LAST_HOLDER_KEY = "leader:last"
+_lease_lock = threading.Lock()
+# last changes of "node" hash, each stamped with node_version it made
+CHANGES_KEY = "node:changes"
+# notified when "node" hash is changed by this process, wakes up watchers
+membership_changed = threading.Condition()
+
+
+def _key(name, shard) -> str:
     """
-    Add a node into redis that key is node's name and value is node's address.
+    Key of registry of a shard, each shard has its own nodes, node_version and leader lease,
+        shard 0 uses keys of an unsharded cluster. Alive keys are shared since names of nodes are unique.
+    """
+    return name if not shard else "{}:shard:{}".format(name, shard)
+
+
+def add_node(name, address, ttl=NODE_TTL, shard=0) -> bool:
+    """
+    Add a node into redis that key is node's name and value is node's address, or refresh it if it's existed.
+    Node is registered in "node" hash, and marked as alive for ttl seconds.
     :param name: node's name
     :param address: node's address
+    :param ttl: seconds that node is treated as alive without another heartbeat
+    :param shard: shard the node serves
     :return: insert result
     """
     try:
-        r.hset("node", name, address)
+        r.set(ALIVE_KEY.format(name), address, ex=ttl)
+        if r.hget(_key("node", shard), name) != address:
+            _change_node("add", name, address, shard)
         return True
     except Exception as e:
         print(e)
         return False
 
 
-def del_node(name) -> int:
+def del_node(name, shard=0) -> int:
     """
     del a node in redis.
     :param name: node's name
+    :param shard: shard the node serves
     :return: del result
     """
-    return r.hdel("node", name)
+    r.delete(ALIVE_KEY.format(name))
+    return _change_node("del", name, shard=shard)
+
+
+def _change_node(op, name, address=None, shard=0) -> int:
+    """
+    Add or del a node in "node" hash, increase node_version and record the change along with it, then wake up watchers.
+    :return: count of node added or deleted
+    """
+    with membership_changed:
+        nodes_key = _key("node", shard)
+        res = r.hset(nodes_key, name, address) if op == "add" else r.hdel(nodes_key, name)
+        if op == "add" or res:
+            version = r.incr(_key("node_version", shard))
+            change = json.dumps({"version": version, "op": op, "name": name, "address": address})
+            pipe = r.pipeline()
+            pipe.rpush(_key(CHANGES_KEY, shard), change)
+            pipe.ltrim(_key(CHANGES_KEY, shard), -MEMBERSHIP_CHANGES_KEPT, -1)
+            pipe.execute()
+            membership_changed.notify_all()
+    return res
+
+
+def get_registered_nodes(shard=0) -> dict:
+    """
+    return all registered node's information of a shard, which changes along with node_version.
+    :return: e.g. {"aaa": "1.1.1.1:5000"}
+    """
+    return r.hgetall(_key("node", shard))
 
 
 def get_all_nodes_from_redis() -> dict:
     """
-    return all node's information.
+    return information of all node which heartbeat is not expired, read by scan and one batch get.
+    :return: e.g. {"aaa": "1.1.1.1:5000"}
+    """
+    keys = list(r.scan_iter(match=ALIVE_KEY.format("*"), count=1000))
+    if not keys:
+        return {}
+    prefix = len(ALIVE_KEY.format(""))
+    return {key[prefix:]: address for key, address in zip(keys, r.mget(keys)) if address}
+
+
+def expire_nodes(shard=0) -> list:
+    """
+    del registered nodes of a shard which heartbeat is expired.
+    :return: name of deleted nodes
+    """
+    alive = get_all_nodes_from_redis()
+    expired = [name for name in get_registered_nodes(shard) if name not in alive]
+    for name in expired:
+        del_node(name, shard)
+    return expired
+
+
+def get_node_address(name, shard=0) -> str:
+    """
+    return address of a registered node.
+    :return: e.g. "1.1.1.1:5000", None if it's not registered
+    """
+    return r.hget(_key("node", shard), name)
+
+
+def get_node_version(shard=0) -> int:
+    """
+    return version of all node's information of a shard,
+        it increases every time a node is added, changed or deleted.
     :return:
     """
-    res = r.hgetall("node")
-    return res
+    return int(r.get(_key("node_version", shard)) or 0)
+
+
+def get_node_changes(version, shard=0) -> (int, list):
+    """
+    return changes of registered nodes after a version.
+    :param version: node_version client has seen
+    :return: current version, and changes after given version in order,
+        e.g. (3, [{"version": 3, "op": "add", "name": "aaa", "address": "1.1.1.1:5000"}]),
+        changes is None if they are not kept any more, client should get all nodes again.
+    """
+    with membership_changed:
+        current = get_node_version(shard)
+        if version == current:
+            return current, []
+        changes = [json.loads(i) for i in r.lrange(_key(CHANGES_KEY, shard), 0, -1)]
+    changes = [i for i in changes if i["version"] > version]
+    if version > current or not changes or changes[0]["version"] != version + 1:
+        return current, None
+    return current, changes
+
+
+def wait_node_changes(version, timeout, shard=0) -> (int, list):
+    """
+    Wait until registered nodes are changed after a version, or timeout.
+    Changes made by other processes are found by checking node_version every second.
+    :return: same as get_node_changes
+    """
+    deadline = time.monotonic() + timeout
+    with membership_changed:
+        while get_node_version(shard) == version and time.monotonic() < deadline:
+            membership_changed.wait(min(1.0, deadline - time.monotonic()))
+    return get_node_changes(version, shard)
+
+
+def hold_lease(name, ttl, shard=0) -> (str, int, int):
+    """
+    Acquire leader lease for a node if no one holds it, or renew it if the node holds it.
+    A node whose lease expired without being released is treated as gone and deleted,
+        so transactions of new leader don't wait for its heartbeat to expire.
+    :param name: node's name
+    :param ttl: seconds that lease is held without another renewal
+    :param shard: shard the node leads
+    :return: name of lease holder, milliseconds before its lease expires, and epoch of its leadership
+    """
+    px = int(ttl * 1000)
+    lease_key, epoch_key, last_key = _key(LEASE_KEY, shard), _key(EPOCH_KEY, shard), _key(LAST_HOLDER_KEY, shard)
+    with _lease_lock:
+        holder = r.get(lease_key)
+        if holder is None and r.set(lease_key, name, px=px, nx=True):
+            last = r.get(last_key)
+            r.set(last_key, name)
+            if last and last != name:
+                print("Node {} lost leader lease, delete it".format(last))
+                del_node(last, shard)
+            return name, px, r.incr(epoch_key)
+        if holder == name:
+            r.set(lease_key, name, px=px)
+            return name, px, int(r.get(epoch_key) or 0)
+    return get_lease_from_redis(shard)
+
+
+def drop_lease(name, shard=0) -> bool:
+    """
+    Release leader lease if the node holds it, so another node acquires it without waiting it expire.
+    :param name: node's name
+    :param shard: shard the node leads
+    :return: if lease is released
+    """
+    with _lease_lock:
+        if r.get(_key(LEASE_KEY, shard)) == name:
+            r.delete(_key(LAST_HOLDER_KEY, shard))
+            return bool(r.delete(_key(LEASE_KEY, shard)))
+    return False
+
+
+def get_lease_from_redis(shard=0) -> (str, int, int):
+    """
+    Get holder of leader lease of a shard.
+    :return: name of lease holder, "" if no one holds it, milliseconds before its lease expires,
+        and epoch of its leadership
+    """
+    pipe = r.pipeline()
+    pipe.get(_key(LEASE_KEY, shard))
+    pipe.pttl(_key(LEASE_KEY, shard))
+    pipe.get(_key(EPOCH_KEY, shard))
+    holder, pttl, epoch = pipe.execute()
+    return holder or "", max(pttl or 0, 0), int(epoch or 0)
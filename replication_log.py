@@ -0,0 +1,203 @@
+import json
+import os
+import threading
+import zlib
+
+
+class ReplicationLog:
+    """
+    Append-only log of replication entries, stored in segment files named by index of their first entry.
+    Each entry is a line of "<crc32 in hex> <json>", and gets an index increasing by one.
+    Appends waiting for durability share fsync, one fsync covers all entries written before it.
+    """
+
+    def __init__(self, path, segment_bytes, retain_segments):
+        """
+        :param path: directory of segment files
+        :param segment_bytes: a new segment is started when current one is larger than it
+        :param retain_segments: count of latest segments never removed by truncate
+        """
+        self.path = path
+        self._segment_bytes = segment_bytes
+        self._retain_segments = retain_segments
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        self._written = 0
+        self._synced = 0
+        self.last_index = 0
+        # max seq committed or aborted in log, db lags behind it until log is applied
+        self.last_seq = 0
+        os.makedirs(path, exist_ok=True)
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith(".log"))
+        # min and max seq committed in each segment, used to skip segments when reading committed data
+        self._seqs = {}
+        for first in self._segments:
+            self._recover(first)
+        if not self._segments:
+            self._segments.append(self.last_index + 1)
+        self._file = open(self._segment_path(self._segments[-1]), "ab")
+
+    def _segment_path(self, first) -> str:
+        return os.path.join(self.path, "{:020d}.log".format(first))
+
+    def _recover(self, first):
+        """
+        Load index and seq of a segment, and cut torn entry at its end which is left by a crash.
+        """
+        valid = 0
+        for entry, end in self._read_segment(first):
+            valid = end
+            self.last_index = entry["index"]
+            self._add_last_seq(entry)
+            if entry["type"] == "commit":
+                self._add_seqs(first, entry)
+        if os.path.getsize(self._segment_path(first)) > valid:
+            print("replication log: cut torn entry at {} of segment {}".format(valid, first))
+            os.truncate(self._segment_path(first), valid)
+
+    def _add_last_seq(self, entry):
+        if entry["type"] != "prepare" and entry.get("last_seq") is not None:
+            self.last_seq = max(self.last_seq, entry["last_seq"])
+
+    def _add_seqs(self, first, entry):
+        low, high = self._seqs.get(first, (entry["first_seq"], entry["last_seq"]))
+        self._seqs[first] = (min(low, entry["first_seq"]), max(high, entry["last_seq"]))
+
+    def _read_segment(self, first):
+        end = 0
+        with open(self._segment_path(first), "rb") as f:
+            for line in f:
+                try:
+                    checksum, body = line.rstrip(b"\n").split(b" ", 1)
+                    if not line.endswith(b"\n") or int(checksum, 16) != zlib.crc32(body):
+                        return
+                    entry = json.loads(body)
+                except ValueError:
+                    return
+                end += len(line)
+                yield entry, end
+
+    def append(self, entries: [dict], sync=True) -> int:
+        """
+        Append entries to log.
+        :param entries: entries, e.g. [{"type": "prepare", "txn_id": "ab12", "data": [...]}]
+        :param sync: wait until entries are durable on disk
+        :return: index of last appended entry
+        """
+        with self._lock:
+            for entry in entries:
+                self.last_index += 1
+                body = json.dumps(dict(entry, index=self.last_index), separators=(",", ":")).encode()
+                self._file.write(b"%08x %s\n" % (zlib.crc32(body), body))
+                self._add_last_seq(entry)
+                if entry["type"] == "commit":
+                    self._add_seqs(self._segments[-1], entry)
+            self._written += 1
+            ticket, last_index = self._written, self.last_index
+            if self._file.tell() >= self._segment_bytes:
+                self._roll()
+            self._appended.notify_all()
+        if sync:
+            self._sync(ticket)
+        return last_index
+
+    def _roll(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._synced = self._written
+        self._segments.append(self.last_index + 1)
+        self._file = open(self._segment_path(self._segments[-1]), "ab")
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _sync(self, ticket):
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return
+            with self._lock:
+                self._file.flush()
+                target = self._written
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._synced = max(self._synced, target)
+
+    def read(self, after_index):
+        """
+        Read entries after given index.
+        :return: generator of entry, e.g. {"index": 2, "type": "commit", "txn_id": "ab12", ...}
+        """
+        with self._lock:
+            self._file.flush()
+            segments = list(self._segments)
+        start = max([first for first in segments if first <= after_index + 1] or [segments[0]])
+        for first in segments:
+            if first < start:
+                continue
+            for entry, end in self._read_segment(first):
+                if entry["index"] > after_index:
+                    yield entry
+
+    def wait(self, index, timeout):
+        """
+        Wait until there's an entry after given index or timeout.
+        """
+        with self._lock:
+            if self.last_index <= index:
+                self._appended.wait(timeout)
+
+    def committed_since(self, seq, limit) -> [dict]:
+        """
+        Read data committed after given seq from log, ordered by seq.
+        Prepare entry of a commit is looked up in its segment and the one before.
+        :param seq: only data with greater seq are returned
+        :param limit: max count of data returned
+        :return: data, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 2}],
+            raise LookupError if log doesn't have all of them.
+        """
+        with self._lock:
+            self._file.flush()
+            segments = list(self._segments)
+            seqs = dict(self._seqs)
+        wanted = [i for i, first in enumerate(segments) if first in seqs and seqs[first][1] > seq]
+        if not wanted:
+            return []
+        if wanted[0] == 0 and segments[0] != 1 and seqs[segments[0]][0] > seq + 1:
+            raise LookupError("log is truncated after seq {}".format(seq))
+        prepared = {}
+        result = []
+        for first in segments[max(0, wanted[0] - 1):]:
+            for entry, end in self._read_segment(first):
+                if entry["type"] == "prepare":
+                    prepared[entry["txn_id"]] = entry["data"]
+                elif entry["type"] == "commit" and entry["last_seq"] > seq:
+                    if entry["txn_id"] not in prepared:
+                        raise LookupError("prepare of {} is not in log".format(entry["txn_id"]))
+                    result.extend(i for i in prepared.pop(entry["txn_id"]) if i["seq"] > seq)
+                    if len(result) >= limit:
+                        return result[:limit]
+                elif entry["type"] in ("commit", "abort"):
+                    prepared.pop(entry["txn_id"], None)
+        return result
+
+    def truncate(self, applied_index) -> int:
+        """
+        Remove segments that all entries are applied, latest segments are always retained.
+        :param applied_index: all entries not greater than it are applied
+        :return: count of removed segments
+        """
+        with self._lock:
+            removable = [first for first, next_first in zip(self._segments, self._segments[1:])
+                         if next_first <= applied_index + 1][:max(0, len(self._segments) - self._retain_segments)]
+            for first in removable:
+                os.remove(self._segment_path(first))
+                self._segments.remove(first)
+                self._seqs.pop(first, None)
+        return len(removable)
@@ -0,0 +1,73 @@
+import threading
+import time
+
+
+class Sequencer:
+    """
+    Hand out ranges of seq to commit rounds, and let rounds decide to submit or roll back one by one in order of seq,
+        so rounds can prepare concurrently while nodes still receive submits in order.
+    Every reset starts a new term, rounds of an old term are not waited for and should not decide with their seq.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._term = 0
+        # last seq handed out, and last seq of rounds decided
+        self._allocated = None
+        self._decided = None
+
+    @property
+    def last_seq(self) -> int:
+        return self._allocated or 0
+
+    def reset(self):
+        """
+        Forget seq handed out, next allocate loads last seq again.
+        """
+        with self._cond:
+            if self._allocated is not None:
+                self._term += 1
+                self._allocated = self._decided = None
+                self._cond.notify_all()
+
+    def allocate(self, count, load) -> (int, int, int):
+        """
+        Hand out a range of seq.
+        :param count: count of seq in range
+        :param load: function returns last seq used, called when it's the first range of a term
+        :return: term, first and last seq of range
+        """
+        with self._cond:
+            if self._allocated is None:
+                self._allocated = self._decided = load()
+            first = self._allocated + 1
+            self._allocated += count
+            return self._term, first, self._allocated
+
+    def wait_turn(self, term, first_seq, timeout=None) -> bool:
+        """
+        Wait until all rounds before given range are decided.
+        If they are not decided in time, a round before is stuck, the term is reset so seq after it can be handed out
+            again, and all rounds of the term waiting their turn give up.
+        :param timeout: seconds to wait, None to wait forever
+        :return: True if it's turn of the range, False if term is over
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._term == term and self._decided != first_seq - 1:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    print("Seq before {} not decided in {}s, reset sequencer".format(first_seq, timeout))
+                    self.reset()
+                    break
+                self._cond.wait(remaining)
+            return self._term == term
+
+    def done(self, term, last_seq):
+        """
+        Mark a range decided, must be called for every range handed out, even if its round failed.
+        """
+        with self._cond:
+            if self._term == term:
+                self._decided = max(self._decided, last_seq)
+                self._cond.notify_all()
@@ -0,0 +1,35 @@
+import bisect
+import hashlib
+
+
+def _hash(key) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring of shards, a data_id belongs to the first point of a shard clockwise from its hash.
+    Each shard has vnodes points spread over the ring, so data_ids are split evenly,
+        and only about 1/n of them move when the nth shard is added.
+    """
+
+    def __init__(self, shards, vnodes=64):
+        """
+        :param shards: id of all shards, e.g. [0, 1]
+        :param vnodes: count of points of each shard on ring
+        """
+        if not shards:
+            raise ValueError("no shard")
+        self.shards = sorted(shards)
+        points = sorted((_hash("{}#{}".format(shard, i)), shard) for shard in self.shards for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_of(self, data_id) -> int:
+        """
+        :return: id of shard that data_id belongs to
+        """
+        if len(self.shards) == 1:
+            return self.shards[0]
+        i = bisect.bisect(self._hashes, _hash(str(data_id))) % len(self._hashes)
+        return self._shards[i]
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import zlib
+
+from utils import pack, unpack
+
+
+class ChunkError(Exception):
+    """
+    A chunk of snapshot is truncated or corrupted.
+    """
+
+
+def encode_chunk(seq, data, level=6, fmt="json") -> bytes:
+    """
+    Encode a chunk of snapshot as a header line followed by compressed data.
+    Header is a json, e.g. {"seq": 10, "cursor": "9", "count": 2, "format": "json", "size": 51, "sha256": "ab12..."},
+        "cursor" is data_id of last data in chunk, "size" and "sha256" are of compressed data.
+    :param seq: seq of snapshot
+    :param data: data of chunk ordered by data_id, e.g. [{"data_id": "1", "raw": "a", "signature": "aaa", "seq": 1}]
+    :param level: zlib compression level
+    :param fmt: encoding of data before compressed, "json" or "msgpack"
+    :return: bytes of chunk
+    """
+    body = pack(data) if fmt == "msgpack" else json.dumps(data, separators=(",", ":")).encode()
+    payload = zlib.compress(body, level)
+    header = {"seq": seq, "cursor": data[-1]["data_id"], "count": len(data), "format": fmt, "size": len(payload),
+              "sha256": hashlib.sha256(payload).hexdigest()}
+    return json.dumps(header).encode() + b"\n" + payload
+
+
+def encode_end(seq) -> bytes:
+    """
+    Encode the mark of end of snapshot, a header without data.
+    """
+    return json.dumps({"seq": seq, "end": True}).encode() + b"\n"
+
+
+def read_chunks(stream):
+    """
+    Read chunks of snapshot from a file-like stream, checksum of each chunk is verified before it's decoded.
+    :return: generator of header and data of chunk, data is empty for the mark of end.
+        raise ChunkError if stream ends before the mark of end, or a chunk is corrupted.
+    """
+    while True:
+        line = stream.readline()
+        if not line.endswith(b"\n"):
+            raise ChunkError("snapshot ends without end mark")
+        header = json.loads(line)
+        if header.get("end"):
+            yield header, []
+            return
+        payload = stream.read(header["size"])
+        if len(payload) != header["size"]:
+            raise ChunkError("chunk after {} is truncated".format(header["cursor"]))
+        if hashlib.sha256(payload).hexdigest() != header["sha256"]:
+            raise ChunkError("checksum of chunk ends at {} mismatched".format(header["cursor"]))
+        body = zlib.decompress(payload)
+        data = unpack(body) if header.get("format") == "msgpack" else json.loads(body)
+        if len(data) != header["count"]:
+            raise ChunkError("chunk ends at {} has {} data, expected {}".format(header["cursor"], len(data),
+                                                                               header["count"]))
+        yield header, data
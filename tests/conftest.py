@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# modules read config at import, tests run them with config_template and an in process redis and sqlite db
+_dir = tempfile.mkdtemp(prefix="dbs-test-")
+config = types.ModuleType("config")
+with open(os.path.join(ROOT, "config_template.py")) as f:
+    exec(f.read(), config.__dict__)
+config.IS_CENTRAL_NODE = False
+config.NODE_NAME = "node0"
+config.REDIS_CONFIG = {"fake": True}
+config.db_config = {"engine": "sqlite", "db_name": os.path.join(_dir, "data.db")}
+config.REPLICATION_LOG_PATH = os.path.join(_dir, "replication_log")
+sys.modules["config"] = config
@@ -0,0 +1,20 @@
+import time
+
+import requests
+
+from bench.cluster import Cluster
+
+
+def test_watch_over_limit_answered_right_away():
+    # no watch is held, nodes poll node list instead
+    with Cluster(2, {"MEMBERSHIP_WATCH_MAX": 0}) as cluster:
+        version = cluster.central.get("/register/watch/")["data"]["version"]
+        start = time.time()
+        r = cluster.central.get("/register/watch/", params={"version": version, "timeout": 10}, timeout=15)
+        assert time.time() - start < 5
+        assert r["data"] == {"version": version, "changes": [], "poll": True}
+        metrics = requests.get(cluster.nodes[0].url("/metrics"), timeout=5).text
+        assert 'dbs_membership_watch_seconds_count{result="poll"}' in metrics
+        leader = cluster.wait_leader()
+        r = requests.put(leader.url("/data/"), json={"id": "a", "raw": "x", "signature": "s"}, timeout=30)
+        assert r.json()["result"] == "ok"
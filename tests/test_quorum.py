@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+
+import requests
+
+import app
+from bench.cluster import Cluster
+from utils import fan_out
+
+NODES = {"node0": "a", "node1": "b", "node2": "c"}
+
+
+def test_quorum_reached_with_majority_including_leader():
+    reached, decided = app.quorum(NODES)
+    assert not reached({"node0": (True, None)})
+    assert reached({"node0": (True, None), "node1": (True, None)})
+    # a majority without leader is not a quorum
+    assert not reached({"node1": (True, None), "node2": (True, None)})
+    assert not decided({"node0": (True, None), "node1": (False, "x")})
+    assert decided({"node0": (True, None), "node1": (True, None)})
+
+
+def test_quorum_decided_when_it_can_not_be_reached():
+    reached, decided = app.quorum(NODES)
+    assert decided({"node0": (False, "x")})
+    assert decided({"node1": (False, "x"), "node2": (False, "x")})
+    reached, decided = app.quorum(dict(NODES, node3="d", node4="e"))
+    assert not reached({"node0": (True, None), "node1": (True, None)})
+    assert reached({"node0": (True, None), "node1": (True, None), "node4": (True, None)})
+    assert not decided({"node1": (False, "x"), "node2": (False, "x")})
+    assert decided({"node1": (False, "x"), "node2": (False, "x"), "node3": (False, "x")})
+
+
+def _call(blocked, calls, started=None, release=None):
+    """
+    :return: call recording its address, call to blocked address sets started and waits for release
+    """
+    def call(address):
+        calls.append(address)
+        if address == blocked:
+            started.set()
+            release.wait(5)
+        return True, None
+    return call
+
+
+def test_fan_out_returns_at_quorum():
+    reached, decided = app.quorum(NODES)
+    release = threading.Event()
+    try:
+        start = time.perf_counter()
+        results, pending = fan_out(_call("c", [], threading.Event(), release), NODES, timeout=5, until=decided)
+        assert time.perf_counter() - start < 4
+        assert reached(results)
+        assert pending == ["node2"]
+    finally:
+        release.set()
+
+
+def test_fan_out_skips_node_with_too_many_calls_in_flight():
+    # calls in flight are counted by name across phases, names are not shared with other tests
+    nodes = {"fast0": "a", "fast1": "b", "slow": "c"}
+    calls, started, release = [], threading.Event(), threading.Event()
+    call = _call("c", calls, started, release)
+    # slow node is still running after its phase gave up on it
+    results, pending = fan_out(call, nodes, timeout=5, max_inflight=1,
+                               until=lambda results: len(results) == 2 and started.wait(5))
+    assert pending == ["slow"] and calls.count("c") == 1
+    results, pending = fan_out(call, nodes, timeout=5, max_inflight=1)
+    assert set(results) == {"fast0", "fast1"} and pending == ["slow"]
+    assert calls.count("c") == 1
+    release.set()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        results, pending = fan_out(call, nodes, timeout=5, max_inflight=1)
+        if not pending:
+            break
+        time.sleep(0.05)
+    assert set(results) == set(nodes) and pending == []
+    assert calls.count("c") == 2
+
+
+def _data(node) -> dict:
+    r = requests.get(node.url("/data/?format=ndjson"), stream=True, timeout=30)
+    return {i["data_id"]: i for i in map(json.loads, filter(None, r.iter_lines()))}
+
+
+def _put_all(node, prefix, count):
+    results = {}
+
+    def put(i):
+        r = requests.put(node.url("/data/"), json={"id": "{}{}".format(prefix, i), "raw": "x", "signature": "s"},
+                         timeout=30).json()
+        results[i] = r.get("result")
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return list(results.values())
+
+
+def _left_behind(leader) -> float:
+    lines = requests.get(leader.url("/metrics"), timeout=5).text.splitlines()
+    return sum(float(line.split()[-1]) for line in lines if line.startswith("dbs_quorum_left_behind_total"))
+
+
+def _wait_converged(cluster, count, timeout=60):
+    expected = _data(cluster.wait_leader())
+    assert len(expected) == count
+    deadline = time.time() + timeout
+    while time.time() < deadline and any(_data(node) != expected for node in cluster.alive_nodes()):
+        time.sleep(0.5)
+    for node in cluster.alive_nodes():
+        assert _data(node) == expected
+
+
+def test_slow_and_killed_followers_catch_up_after_majority_commit():
+    with Cluster(3, {"COMMIT_POLICY": "majority"}, proxy=True) as cluster:
+        leader = cluster.wait_leader()
+        slow, other = cluster.followers()
+
+        # leader and the other follower are a quorum, slow follower is left behind and catches up later
+        slow.proxy.delay = 0.5
+        assert _put_all(leader, "s", 20) == ["ok"] * 20
+        assert _left_behind(leader) > 0
+        slow.proxy.delay = 0
+        _wait_converged(cluster, 20)
+
+        # a killed follower doesn't fail writes, and has all data after restart
+        other.kill()
+        assert _put_all(leader, "k", 20) == ["ok"] * 20
+        other.start()
+        other.wait_ready()
+        _wait_converged(cluster, 40)
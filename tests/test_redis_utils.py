@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+import redis_utils
+from fake_redis import FakeRedis
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(redis_utils, "r", FakeRedis())
+
+
+def test_add_node_refresh():
+    assert redis_utils.add_node("aaa", "1.1.1.1:5000", ttl=10)
+    assert redis_utils.get_node_version() == 1
+    # heartbeat of same address only refreshes alive key
+    assert redis_utils.add_node("aaa", "1.1.1.1:5000", ttl=10)
+    assert redis_utils.get_node_version() == 1
+    assert redis_utils.add_node("aaa", "2.2.2.2:5000", ttl=10)
+    assert redis_utils.get_node_version() == 2
+    assert redis_utils.get_registered_nodes() == {"aaa": "2.2.2.2:5000"}
+    assert redis_utils.get_node_changes(0) == (2, [
+        {"version": 1, "op": "add", "name": "aaa", "address": "1.1.1.1:5000"},
+        {"version": 2, "op": "add", "name": "aaa", "address": "2.2.2.2:5000"},
+    ])
+
+
+def test_expire_nodes_after_ttl():
+    redis_utils.add_node("aaa", "1.1.1.1:5000", ttl=0.2)
+    redis_utils.add_node("bbb", "2.2.2.2:5000", ttl=10)
+    assert redis_utils.expire_nodes() == []
+    time.sleep(0.3)
+    assert redis_utils.get_all_nodes_from_redis() == {"bbb": "2.2.2.2:5000"}
+    assert redis_utils.expire_nodes() == ["aaa"]
+    assert redis_utils.get_registered_nodes() == {"bbb": "2.2.2.2:5000"}
+    assert redis_utils.get_node_changes(2)[1] == [{"version": 3, "op": "del", "name": "aaa", "address": None}]
+
+
+def test_get_all_nodes_from_redis():
+    assert redis_utils.get_all_nodes_from_redis() == {}
+    redis_utils.add_node("aaa", "1.1.1.1:5000", ttl=10)
+    redis_utils.add_node("bbb", "2.2.2.2:5000", ttl=10)
+    assert redis_utils.get_all_nodes_from_redis() == {"aaa": "1.1.1.1:5000", "bbb": "2.2.2.2:5000"}
+    redis_utils.del_node("aaa")
+    assert redis_utils.get_all_nodes_from_redis() == {"bbb": "2.2.2.2:5000"}
+
+
+def test_lease_epochs():
+    redis_utils.add_node("aaa", "1.1.1.1:5000", ttl=10)
+    redis_utils.add_node("bbb", "2.2.2.2:5000", ttl=10)
+    holder, ttl, epoch = redis_utils.hold_lease("aaa", 1)
+    assert (holder, ttl, epoch) == ("aaa", 1000, 1)
+    # renewal keeps epoch, another node can't take it
+    assert redis_utils.hold_lease("aaa", 1)[::2] == ("aaa", 1)
+    assert redis_utils.hold_lease("bbb", 1)[::2] == ("aaa", 1)
+    assert not redis_utils.drop_lease("bbb")
+    assert redis_utils.drop_lease("aaa")
+    assert redis_utils.get_lease_from_redis() == ("", 0, 1)
+    # released lease is taken at once under a new epoch, its holder stays registered
+    assert redis_utils.hold_lease("bbb", 0.1)[::2] == ("bbb", 2)
+    assert "aaa" in redis_utils.get_registered_nodes()
+    # expired lease is taken under a new epoch, and its holder is deleted
+    time.sleep(0.2)
+    assert redis_utils.hold_lease("aaa", 1)[::2] == ("aaa", 3)
+    assert redis_utils.get_registered_nodes() == {"aaa": "1.1.1.1:5000"}
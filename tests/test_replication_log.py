@@ -0,0 +1,66 @@
+import time
+
+import requests
+
+import app
+from bench.cluster import Cluster
+from db import init_db, set_log_applied_index
+from replication_log import ReplicationLog
+
+
+def _data(*data_ids):
+    return [{"data_id": i, "raw": "a", "signature": "s", "seq": n} for n, i in enumerate(data_ids, 1)]
+
+
+def test_unapplied_entries_are_tracked_after_restart(tmp_path, monkeypatch):
+    log = ReplicationLog(str(tmp_path), 1024 * 1024, 4)
+    log.append([{"type": "prepare", "txn_id": "t1", "data": _data("1", "2")},
+                {"type": "commit", "txn_id": "t1", "first_seq": 1, "last_seq": 2},
+                {"type": "prepare", "txn_id": "t2", "data": _data("3")},
+                {"type": "commit", "txn_id": "t2", "first_seq": 3, "last_seq": 3},
+                {"type": "prepare", "txn_id": "t3", "data": _data("4")},
+                {"type": "prepare", "txn_id": "t4", "data": _data("5")},
+                {"type": "abort", "txn_id": "t4", "first_seq": 5, "last_seq": 5}])
+    init_db()
+    # t1 is applied to db before restart
+    set_log_applied_index(2)
+
+    monkeypatch.setattr(app, "LOG", ReplicationLog(str(tmp_path), 1024 * 1024, 4))
+    monkeypatch.setattr(app, "LOG_TXNS", {})
+    monkeypatch.setattr(app, "UNAPPLIED_IDS", set())
+    app.load_log_entries()
+    assert app.UNAPPLIED_IDS == {"3"}
+    assert app.LOG_TXNS == {"t3": ["4"]}
+
+
+def test_extra_fields_of_data_do_not_reach_log():
+    with Cluster(3, {"REPLICATION_LOG_ENABLED": True}) as cluster:
+        leader = cluster.wait_leader()
+        for node, body in ((cluster.nodes[0], {"id": "a", "raw": "x", "signature": "s", "extra": 1}),
+                           (leader, [{"data_id": "b", "raw": "x", "signature": "s", "extra": 1}]),
+                           (leader, {"id": "c", "raw": "x", "signature": "s"})):
+            path = "/proposal/" if isinstance(body, list) else "/data/"
+            r = requests.put(node.url(path), json=body, timeout=30).json()
+            assert r["result"] == "ok", r
+        # every node applies all of them from log to db, applier is not stuck on a bad entry
+        deadline = time.time() + 30
+        while time.time() < deadline and any(node.count() < 3 for node in cluster.nodes):
+            time.sleep(0.2)
+        for node in cluster.nodes:
+            assert node.get("/data/?limit=10")["data"]["items"] == [
+                {"data_id": i, "raw": "x", "signature": "s", "seq": n} for n, i in enumerate("abc", 1)]
+
+
+def test_last_seq_includes_commits_not_applied(tmp_path, monkeypatch):
+    log = ReplicationLog(str(tmp_path), 1024 * 1024, 4)
+    log.append([{"type": "prepare", "txn_id": "t1", "data": _data("1", "2")},
+                {"type": "commit", "txn_id": "t1", "first_seq": 1, "last_seq": 2},
+                {"type": "prepare", "txn_id": "t2", "data": _data("3")},
+                {"type": "abort", "txn_id": "t2", "first_seq": 3, "last_seq": 3},
+                {"type": "prepare", "txn_id": "t3", "data": _data("4")}])
+    assert log.last_seq == 3
+    # recovered from segments after restart, a new leader doesn't hand out seq used in log
+    monkeypatch.setattr(app, "LOG", ReplicationLog(str(tmp_path), 1024 * 1024, 4))
+    init_db()
+    assert app.LOG.last_seq == 3
+    assert app.last_used_seq() == 3
@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+import app
+from db import init_db
+from sequencer import Sequencer
+
+
+def test_rounds_decide_in_order_of_seq():
+    sequencer = Sequencer()
+    first = sequencer.allocate(2, lambda: 10)
+    second = sequencer.allocate(1, lambda: 0)
+    assert first == (0, 11, 12) and second == (0, 13, 13)
+    turns = []
+    waiter = threading.Thread(target=lambda: turns.append(sequencer.wait_turn(0, 13, timeout=5)))
+    waiter.start()
+    assert sequencer.wait_turn(0, 11, timeout=0)
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    sequencer.done(0, 12)
+    waiter.join(5)
+    assert turns == [True]
+
+
+def test_wait_turn_timeout_starts_new_term():
+    sequencer = Sequencer()
+    sequencer.allocate(1, lambda: 0)
+    term, first_seq, last_seq = sequencer.allocate(1, lambda: 0)
+    # round before it never decides
+    assert not sequencer.wait_turn(term, first_seq, timeout=0.1)
+    sequencer.done(term, last_seq)
+    # seq are handed out again from last seq used
+    assert sequencer.allocate(1, lambda: 0) == (term + 1, 1, 1)
+
+
+def test_round_failed_before_turn_skips_its_seq(monkeypatch):
+    init_db()
+    rollbacks = []
+
+    def prepare(txn_id, data):
+        raise RuntimeError("prepare broke")
+
+    monkeypatch.setattr(app, "sequencer", Sequencer())
+    monkeypatch.setattr(app, "LEADER_LEASE_ENABLED", False)
+    monkeypatch.setattr(app, "prepare", prepare)
+    monkeypatch.setattr(app, "rollback", lambda *args: rollbacks.append(args) or [])
+    records = [{"data_id": "a", "raw": "x", "signature": "s"}, {"data_id": "b", "raw": "x", "signature": "s"}]
+    with pytest.raises(RuntimeError):
+        app._commit_reserved(records, [0, 1], [None, None])
+    # all nodes skip seq of the round before it's marked decided, so next round submits in order
+    assert [args[0] for args in rollbacks] == [None] and rollbacks[0][2:] == (1, 2)
+    assert app.sequencer.wait_turn(0, 3, timeout=0)
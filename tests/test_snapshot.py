@@ -0,0 +1,20 @@
+import pytest
+import requests
+
+import api_utils
+from bench.cluster import Cluster
+
+
+@pytest.mark.parametrize("wire_format", ["json", "msgpack"])
+def test_refused_snapshot_raises_lookup_error(wire_format, monkeypatch):
+    # error body is encoded in format the client accepts
+    headers = {"Accept": "{}, application/json;q=0.9".format(api_utils.MSGPACK_MIMETYPE)} \
+        if wire_format == "msgpack" else {}
+    monkeypatch.setattr(api_utils, "_headers", headers)
+    with Cluster(1) as cluster:
+        node = cluster.nodes[0]
+        requests.put(node.url("/data/"), json={"id": "a", "raw": "x", "signature": "s"}, timeout=30)
+        with pytest.raises(LookupError):
+            list(api_utils.iter_snapshot_chunks(node.address, seq=99))
+        chunks = list(api_utils.iter_snapshot_chunks(node.address))
+        assert chunks[-1][0] == {"end": True, "seq": 1}
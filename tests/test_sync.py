@@ -0,0 +1,15 @@
+import requests
+
+import api_utils
+from bench.cluster import Cluster
+
+
+def test_iter_data_since_page_clamped_by_node():
+    with Cluster(1, {"DATA_PAGE_MAX_LIMIT": 2}) as cluster:
+        node = cluster.nodes[0]
+        for i in range(5):
+            data = {"id": str(i), "raw": "x", "signature": "s"}
+            assert requests.put(node.url("/data/"), json=data, timeout=30).json()["result"] == "ok"
+        pages = list(api_utils.iter_data_since(node.address, 0, page_size=10))
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert [data["seq"] for page in pages for data in page] == [1, 2, 3, 4, 5]
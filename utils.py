@@ -1,26 +1,217 @@
-from flask import Flask, make_response, jsonify
+import base64
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
 
+from flask import Flask, make_response, jsonify, request
+from config import FAN_OUT_WORKERS
+from metrics import observe, inc
 
-def validate_data(data) -> bool:
-    return True
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="fan-out")
+# calls of fan_out to each node still running, including ones not waited for any more
+_inflight = Counter()
+_inflight_lock = threading.Lock()
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+def pack(data) -> bytes:
+    """
+    Encode data in msgpack, raise if msgpack is not installed.
+    """
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack(body: bytes):
+    """
+    Decode data in msgpack, raise if msgpack is not installed.
+    """
+    return msgpack.unpackb(body, raw=False)
+
+
+def wants_msgpack() -> bool:
+    """
+    :return: if client of current request prefers msgpack to json, only nodes ask for it, other clients get json
+    """
+    if msgpack is None:
+        return False
+    return request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+
+def get_request_data(silent=False):
+    """
+    :param silent: return None instead of raise if body can't be decoded
+    :return: decoded body of current request, in msgpack or json according to its Content-Type
+    """
+    if request.mimetype == MSGPACK_MIMETYPE:
+        try:
+            return unpack(request.get_data())
+        except Exception:
+            if silent:
+                return None
+            raise
+    return request.get_json(silent=silent)
+
+
+def _make_body_response(body, status=200) -> Flask.response_class:
+    if wants_msgpack():
+        response = make_response(pack(body), status)
+        response.mimetype = MSGPACK_MIMETYPE
+        return response
+    return make_response(jsonify(body), status)
+
+
+def valid_data_id(data_id) -> bool:
+    """
+    :return: if data_id can be stored and hashed, a non-empty string
+    """
+    return isinstance(data_id, str) and data_id != ""
+
+
+def validate_data(data, id_key="id") -> bool:
+    """
+    :param data: data from client, e.g. {"id": "1", "raw": "a", "signature": "aaa"}
+    :param id_key: key of data_id, "data_id" for data proposed to leader
+    """
+    return (isinstance(data, dict) and valid_data_id(data.get(id_key)) and isinstance(data.get("raw"), str)
+            and isinstance(data.get("signature"), str))
+
+
+def parse_limit(value, max_limit) -> int:
+    """
+    :param value: "limit" of query string, None for max_limit
+    :return: limit of a page, at most max_limit, raise ValueError if it's not a positive integer
+    """
+    limit = max_limit if value is None else int(value)
+    if limit < 1:
+        raise ValueError("limit must be positive: {}".format(value))
+    return min(limit, max_limit)
+
+
+def encode_cursor(data_id) -> str:
+    """
+    :return: opaque cursor points after given data_id
+    """
+    return base64.urlsafe_b64encode(data_id.encode()).decode()
+
+
+def decode_cursor(cursor) -> str:
+    """
+    :return: data_id that given cursor points after, raise ValueError if cursor is invalid
+    """
+    try:
+        return base64.b64decode(cursor.encode(), altchars=b"-_", validate=True).decode()
+    except Exception as e:
+        raise ValueError("invalid cursor: {}".format(cursor)) from e
 
 
 def make_ok_response() -> Flask.response_class:
     """
     :return: return a default ok response
     """
-    return make_response(jsonify({"result": "ok"}), 200)
+    return _make_body_response({"result": "ok"})
 
 
-def make_json_response(data) -> Flask.response_class:
+def make_json_response(data, etag=None) -> Flask.response_class:
     """
+    :param etag: version of data, will be set as ETag header if given
     :return: return an ok response with some data
     """
-    return make_response(jsonify({"result": "ok", "data": data}), 200)
+    response = _make_body_response({"result": "ok", "data": data})
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def make_not_modified_response(etag) -> Flask.response_class:
+    """
+    :return: return an empty response tells client its cached data with this ETag is still fresh
+    """
+    response = make_response("", 304)
+    response.set_etag(etag)
+    return response
 
 
 def make_error_response(msg) -> Flask.response_class:
     """
     :return: return an ok response with some data
     """
-    return make_response(jsonify({"result": "error", "msg": msg}), 200)
+    return _make_body_response({"result": "error", "msg": msg})
+
+
+def _timed_call(phase, name, func, address, *args):
+    start = time.perf_counter()
+    try:
+        return func(address, *args)
+    finally:
+        observe("dbs_peer_seconds", time.perf_counter() - start, phase=phase, peer=name)
+
+
+def _tracked_call(name, func, *args):
+    try:
+        return func(*args)
+    finally:
+        with _inflight_lock:
+            _inflight[name] -= 1
+
+
+def fan_out(func, nodes: dict, *args, timeout=None, abort=None, until=None, max_inflight=None,
+            phase=None, executor=None) -> (dict, list):
+    """
+    Call func(address, *args) for all nodes concurrently and gather results as they come in.
+    :param func: function to call, its first param is node's address
+    :param nodes: nodes to call, e.g. {"aaa": "1.1.1.1:5000"}
+    :param timeout: deadline of the whole phase in seconds, None means wait for all nodes
+    :param abort: check on a result, stop waiting for others as soon as it returns True
+    :param until: check on all results gathered, stop waiting for others as soon as it returns True
+    :param max_inflight: a node with so many calls still running, e.g. not waited for by previous phases,
+        is not called again and treated as not finished
+    :param phase: name of phase, latency of each node is recorded to metrics under it if given
+    :param executor: executor running calls, shared one of all phases by default
+    :return: dict of node's name and its result, and list of node's name that not finished
+    """
+    skipped = []
+    with _inflight_lock:
+        for name in list(nodes):
+            if max_inflight is not None and _inflight[name] >= max_inflight:
+                skipped.append(name)
+            else:
+                _inflight[name] += 1
+    futures = {}
+    for name, address in nodes.items():
+        if name in skipped:
+            continue
+        call = (_timed_call, phase, name, func, address) if phase else (func, address)
+        futures[(executor or _executor).submit(_tracked_call, name, *call, *args)] = name
+    results = {}
+    enough = False
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            name = futures[future]
+            results[name] = future.result()
+            if abort and abort(results[name]):
+                break
+            if until and until(results):
+                enough = True
+                break
+    except TimeoutError:
+        print("fan out {} timeout after {}s".format(func.__name__, timeout))
+    pending = []
+    for future, name in futures.items():
+        if name not in results:
+            if future.cancel():
+                with _inflight_lock:
+                    _inflight[name] -= 1
+            pending.append(name)
+            if phase and not enough:
+                inc("dbs_peer_timeouts_total", phase=phase, peer=name)
+    if phase:
+        for name in skipped:
+            inc("dbs_peer_skipped_total", phase=phase, peer=name)
+    return results, pending + skipped